@@ -1,11 +1,23 @@
 import os
+import re
 import sys
+import csv
 import glob
+import math
 import json
+import errno
+import time
+import heapq
+import bisect
+import random
 import fnmatch
+import hashlib
 import logging
 import pathlib
+import tempfile
+import sqlite3
 import argparse
+import collections
 import pandas as pd
 from datetime import datetime
 from datetime import timedelta
@@ -47,6 +59,14 @@ def validateArgs(args):
             parser.error("--timeslice requires -f/--file")
         if args.output is None:
             parser.error("--timeslice requires -o/--output")
+    if args.timeslicebatch is not None:
+        if args.file is None:
+            parser.error("--timeslicebatch requires -f/--file")
+        if args.output is None:
+            parser.error("--timeslicebatch requires -o/--output")
+    if args.split is True:
+        if args.timeslicebatch is None:
+            parser.error("--split requires --timeslicebatch")
     if args.timeframe is not None:
         if args.file is None:
             parser.error("--timeframe requires -f/--file")
@@ -81,6 +101,59 @@ def validateArgs(args):
             parser.error("--gcloudformatter requires -f/--file")
         if args.file is None:
             parser.error("--gcloudformatter requires -o/--output")
+    if args.follow is True:
+        if args.statistics is not True and args.timeframe is None and args.filter is None:
+            parser.error("--follow requires --statistics, --timeframe or --filter")
+        if args.partition is not None or args.format != 'json':
+            parser.error("--follow cannot be used with --partition or --format")
+    if args.checkpoint is not None:
+        if args.follow is not True:
+            parser.error("--checkpoint requires --follow")
+    if args.sample is not None:
+        if args.statistics is not True:
+            parser.error("--sample requires --statistics")
+        if args.follow is True:
+            parser.error("--sample cannot be used with --follow")
+        if args.sample <= 0 or args.sample > 1:
+            parser.error("--sample must be a fraction between 0 and 1. E.g. 0.01")
+    if args.sketch is not None:
+        if args.statistics is not True:
+            parser.error("--sketch requires --statistics")
+        if args.follow is True or args.sample is not None:
+            parser.error("--sketch cannot be used with --follow or --sample")
+    if args.index is True:
+        if args.file is None:
+            parser.error("--index requires -f/--file. Wildcards and --recurse accepted")
+        if args.type is None:
+            parser.error("--index requires -t/--type field paths. E.g. -t insertId")
+        if args.db is None:
+            parser.error("--index requires --db")
+    if args.lookup is not None:
+        if args.db is None:
+            parser.error("--lookup requires --db")
+        if args.output is None:
+            parser.error("--lookup requires -o/--output")
+    if args.sort is not None:
+        if args.file is None:
+            parser.error("--sort requires -f/--file")
+        if args.output is None:
+            parser.error("--sort requires -o/--output")
+        if args.memory <= 0:
+            parser.error("--memory must be a positive number of MB. E.g. 512")
+    if args.export is not None:
+        if args.file is None:
+            parser.error("--export requires -f/--file")
+        if args.output is None:
+            parser.error("--export requires -o/--output")
+    if args.format != 'json':
+        if args.timeslice is None and args.timeframe is None and args.filter is None \
+                and args.timeslicebatch is None:
+            parser.error("--format requires --timeslice, --timeslicebatch, --timeframe or --filter")
+        if args.partition is not None or args.split is True:
+            parser.error("--format cannot be used with --partition or --split")
+    if args.partition is not None:
+        if args.timeslice is None and args.timeframe is None and args.filter is None:
+            parser.error("--partition requires --timeslice, --timeframe or --filter")
 
 
 def continuePrompt(cont):
@@ -153,6 +226,296 @@ def writeOutput(data, encode, output):
         return
 
 
+def getField(log, fieldPath):
+    """Reads a nested value from a json log using a dot separated field path. \
+        E.g. protoPayload.authenticationInfo.principalEmail
+
+    Args:
+        log: json log
+        fieldPath: dot separated field path
+
+    Returns:
+        value: the field value (None if the field is not present)
+    """
+    value = log
+    for field in fieldPath.split("."):
+        if not isinstance(value, dict) or field not in value:
+            return None
+        value = value[field]
+    return value
+
+
+class PartitionWriter:
+    """Writes json logs to one file per partition in an output directory. \
+        The partition is chosen by a field path (e.g. resource.type) or, if it \
+        contains a % directive, a time bucket template applied to the log \
+        timestamp (e.g. %Y-%m-%d_%H). At most maxOpen buffered file handles \
+        are kept open; the least recently used handle is closed when the pool is full.
+    """
+
+    def __init__(self, output, partition, maxOpen=256):
+        self.output = output
+        self.partition = partition
+        self.maxOpen = maxOpen
+        self.handles = collections.OrderedDict()
+        os.makedirs(output, exist_ok=True)
+
+    def getKey(self, log):
+        """Calculates the partition key of a json log.
+
+        Args:
+            log: json log
+
+        Returns:
+            key: partition key
+        """
+        if "%" in self.partition:
+            try:
+                tmp = datetime.strptime(log['timestamp'][0:19], '%Y-%m-%dT%H:%M:%S')
+            except (KeyError, ValueError):
+                return 'no value'
+            return tmp.strftime(self.partition)
+        value = getField(log, self.partition)
+        if value is None:
+            return 'no value'
+        return str(value)
+
+    def getPath(self, key):
+        """Builds the partition file path for a partition key.
+
+        Args:
+            key: partition key
+
+        Returns:
+            path: partition file path
+        """
+        name = re.sub(r'[^A-Za-z0-9._@-]', '_', key)
+        if name != key:
+            # Keep keys that only differ in replaced characters in separate files
+            name += "-" + hashlib.sha1(key.encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self.output, name + ".json")
+
+    def write(self, log, key=None):
+        """Writes a json log to its partition file.
+
+        Args:
+            log: json log
+            key: partition key (calculated from the log if None)
+
+        Returns:
+            None
+        """
+        if key is None:
+            key = self.getKey(log)
+        handle = self.handles.pop(key, None)
+        if handle is None:
+            if len(self.handles) >= self.maxOpen:
+                oldKey, oldHandle = self.handles.popitem(last=False)
+                logger.debug("closing partition {}".format(oldKey))
+                oldHandle.close()
+            path = self.getPath(key)
+            logger.debug("opening partition {}".format(path))
+            try:
+                handle = open(path, 'a', buffering=partitionBufferSize)
+            except OSError:
+                raise Exception(logger.warning("Error: Failed to open {}".format(path)))
+        self.handles[key] = handle
+        json.dump(log, handle)
+        handle.write("\n")
+
+    def close(self):
+        """Flushes and closes all open partition files.
+
+        Returns:
+            None
+        """
+        while len(self.handles) > 0:
+            key, handle = self.handles.popitem(last=False)
+            handle.close()
+
+
+def flattenLog(log, prefix=''):
+    """Flattens a nested json log into dot separated field paths. \
+        Arrays are kept as json strings.
+
+    Args:
+        log: json log
+        prefix: field path prefix of nested values
+
+    Returns:
+        flat: dictionary of field path to value
+    """
+    flat = {}
+    for key, value in log.items():
+        path = prefix + key
+        if isinstance(value, dict):
+            flat.update(flattenLog(value, path + "."))
+        elif isinstance(value, list):
+            flat[path] = json.dumps(value)
+        else:
+            flat[path] = value
+    return flat
+
+
+class TabularWriter:
+    """Writes json logs as flattened rows to a csv or parquet file. Rows are \
+        buffered and written in row groups of rowGroupSize rows. If no columns \
+        are given they are inferred from the field paths of the first row group; \
+        fields first seen after that are not exported, and are counted in a warning on close.
+    """
+
+    def __init__(self, output, outputFormat, columns=None, rowGroupSize=10000):
+        self.output = output
+        self.outputFormat = outputFormat
+        self.columns = columns
+        self.rowGroupSize = rowGroupSize
+        self.rows = []
+        self.handle = None
+        self.writer = None
+        self.inferred = columns is None
+        self.dropped = set()
+        if outputFormat == 'parquet':
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise Exception(logger.warning("Error: parquet output requires pyarrow. \
+                    Install it with: pip install pyarrow"))
+            self.pyarrow = pyarrow
+        elif outputFormat != 'csv':
+            raise ValueError("Unsupported tabular format: {}".format(outputFormat))
+
+    def write(self, log):
+        """Buffers a json log as a flattened row, writing a row group when the buffer is full.
+
+        Args:
+            log: json log
+
+        Returns:
+            None
+        """
+        self.rows.append(flattenLog(log))
+        if len(self.rows) >= self.rowGroupSize:
+            self.flush()
+
+    def flush(self):
+        """Writes buffered rows as a row group.
+
+        Returns:
+            None
+        """
+        if self.columns is None:
+            columns = {}
+            for row in self.rows:
+                for key in row:
+                    columns[key] = None
+            self.columns = list(columns)
+            logger.info("Exporting {} columns".format(len(self.columns)))
+        elif self.inferred:
+            known = set(self.columns)
+            for row in self.rows:
+                self.dropped.update(key for key in row if key not in known)
+        if len(self.rows) == 0 and self.handle is not None:
+            return
+        values = [[self.formatValue(row.get(column)) for column in self.columns] for row in self.rows]
+        self.rows = []
+        if self.outputFormat == 'csv':
+            if self.handle is None:
+                self.handle = open(self.output, 'w', newline='', encoding='utf-8')
+                self.writer = csv.writer(self.handle)
+                self.writer.writerow(self.columns)
+            self.writer.writerows(values)
+        else:
+            schema = self.pyarrow.schema([(column, self.pyarrow.string()) for column in self.columns])
+            if self.writer is None:
+                self.writer = self.pyarrow.parquet.ParquetWriter(self.output, schema)
+                self.handle = self.writer
+            if len(values) > 0:
+                table = self.pyarrow.Table.from_arrays(
+                    [self.pyarrow.array([row[i] for row in values], self.pyarrow.string())
+                     for i in range(len(self.columns))], schema=schema)
+                self.writer.write_table(table)
+
+    def formatValue(self, value):
+        """Converts a flattened value to a cell value.
+
+        Args:
+            value: flattened value
+
+        Returns:
+            cell value (None or empty string for missing values)
+        """
+        if value is None:
+            return None if self.outputFormat == 'parquet' else ''
+        if isinstance(value, bool):
+            return json.dumps(value)
+        return str(value)
+
+    def close(self):
+        """Writes any buffered rows and closes the output file.
+
+        Returns:
+            None
+        """
+        self.flush()
+        if self.handle is not None:
+            self.handle.close()
+        if len(self.dropped) > 0:
+            logger.warning("{} fields first seen after the columns were inferred were not exported. \
+                Use --columns to export them".format(len(self.dropped)))
+
+
+def openWriter(output, partition, outputFormat='json', columns=None):
+    """Creates a partition or tabular writer when output is not a single json lines file.
+
+    Args:
+        output: output file, or output directory when partitioning
+        partition: field path or time bucket template (None for a single output file)
+        outputFormat: json, csv or parquet
+        columns: array of field paths to export to csv or parquet (None to infer)
+
+    Returns:
+        writer: PartitionWriter or TabularWriter, or None for a single json lines output file
+    """
+    if outputFormat != 'json':
+        logger.info("Exporting {} to {}".format(outputFormat, output))
+        return TabularWriter(output, outputFormat, columns)
+    if partition is None:
+        return None
+    logger.info("Partitioning output by {} into {}".format(partition, output))
+    return PartitionWriter(output, partition)
+
+
+def emitLog(log, output, writer):
+    """Writes a json log to the output file or to its partition.
+
+    Args:
+        log: json log
+        output: output file
+        writer: PartitionWriter or TabularWriter (None to write to the output file)
+
+    Returns:
+        None
+    """
+    if writer is None:
+        writeOutput(log, True, output)
+    else:
+        writer.write(log)
+
+
+def closeWriter(writer):
+    """Closes a partition or tabular writer, if one is in use.
+
+    Args:
+        writer: PartitionWriter, TabularWriter or None
+
+    Returns:
+        None
+    """
+    if writer is not None:
+        writer.close()
+
+
 def pdFrame(file):
     """Creates a pandas data frame from a json log file
 
@@ -163,28 +526,41 @@ def pdFrame(file):
         pandas data frame
     """
     logger.debug("creating pandas data frame from {}".format(file))
-    data = []
     with open(file) as f:
-        for line in f:
-            tmp = []
-            log = json.loads(line)
-            try:
-                tmp.append(pd.Timestamp(log['timestamp']))
-            except KeyError:
-                tmp.append('no value')
-            try:
-                tmp.append(str(log['resource']['type']))
-            except KeyError:
-                tmp.append('no value')
-            try:
-                tmp.append(str(log['severity']))
-            except KeyError:
-                tmp.append('no value')
-            try:
-                tmp.append(str(log['protoPayload']['authenticationInfo']['principalEmail']))
-            except KeyError:
-                tmp.append('no value')
-            data.append(tmp)
+        logs = pdFrameLines(f)
+    return logs
+
+
+def pdFrameLines(lines):
+    """Creates a pandas data frame from json log lines
+
+    Args:
+        lines: iterable of json log lines
+
+    Returns:
+        pandas data frame
+    """
+    data = []
+    for line in lines:
+        tmp = []
+        log = json.loads(line)
+        try:
+            tmp.append(pd.Timestamp(log['timestamp']))
+        except KeyError:
+            tmp.append('no value')
+        try:
+            tmp.append(str(log['resource']['type']))
+        except KeyError:
+            tmp.append('no value')
+        try:
+            tmp.append(str(log['severity']))
+        except KeyError:
+            tmp.append('no value')
+        try:
+            tmp.append(str(log['protoPayload']['authenticationInfo']['principalEmail']))
+        except KeyError:
+            tmp.append('no value')
+        data.append(tmp)
 
     fieldNames = ['timestamp', 'resourceType', 'severity', 'account']
     logs = pd.DataFrame(data, columns=fieldNames)
@@ -274,18 +650,514 @@ def statistics(file):
         None
     """
     logs = pdFrame(file)
+    minVal, maxVal = statistics_chronology(logs)
+    printStatistics(statistics_len(logs),
+                    minVal,
+                    maxVal,
+                    statistics_byType(logs),
+                    statistics_byAccount(logs),
+                    statistics_bySeverity(logs))
+
+
+def readHeadLines(f, count):
+    """Reads up to count lines from the start of a binary file object.
+
+    Args:
+        f: binary file object
+        count: maximum number of lines to read
+
+    Returns:
+        lines: array of lines
+    """
+    f.seek(0)
+    lines = []
+    for line in f:
+        if len(lines) >= count:
+            break
+        lines.append(line)
+    return lines
+
+
+def readLastLine(f, size):
+    """Reads the last complete line of a binary file object.
+
+    Args:
+        f: binary file object
+        size: file size in bytes
+
+    Returns:
+        line: the last line (empty if the file is empty)
+    """
+    blockSize = 64 * 1024
+    while True:
+        start = max(0, size - blockSize)
+        f.seek(start)
+        lines = f.read(size - start).splitlines()
+        lines = [line for line in lines if len(line.strip()) > 0]
+        if start == 0 or len(lines) > 1:
+            if len(lines) == 0:
+                return b''
+            return lines[-1]
+        blockSize *= 2
+
+
+def findLineStart(f, offset):
+    """Finds the start of the line containing a byte offset of a binary file object.
+
+    Args:
+        f: binary file object
+        offset: byte offset
+
+    Returns:
+        start: byte offset of the start of the line
+    """
+    pos = offset
+    blockSize = 4096
+    while pos > 0:
+        start = max(0, pos - blockSize)
+        f.seek(start)
+        block = f.read(pos - start)
+        index = block.rfind(b"\n")
+        if index >= 0:
+            return start + index + 1
+        pos = start
+        blockSize *= 2
+    return 0
+
+
+def sampleLines(file, fraction, seed=None):
+    """Samples json log lines at random byte offsets without reading the whole file. \
+        Each offset selects the line containing it, so a line is drawn with \
+        probability proportional to its length. Each sampled line is weighted by \
+        file size / (draws * line length), which removes that bias: the sum of \
+        weights is an unbiased estimate of the number of lines. Draws that land on \
+        blank lines return no line but still count as draws (they contribute zero).
+
+    Args:
+        file: json log file
+        fraction: approximate fraction of lines to sample (0 < fraction <= 1)
+        seed: optional random seed for repeatable samples
+
+    Returns:
+        lines: array of sampled json log lines
+        weights: array of the weight of each sampled line (None if every line was read)
+        draws: number of random draws, including blank ones (None if every line was read)
+    """
+    size = os.path.getsize(file)
+    with open(file, 'rb') as f:
+        head = readHeadLines(f, 100)
+        if len(head) == 0:
+            return [], None, None
+        avgLength = sum(len(line) for line in head) / len(head)
+        estimatedTotal = size / avgLength
+        sampleSize = max(1, int(round(fraction * estimatedTotal)))
+        if fraction >= 1 or sampleSize * 2 >= estimatedTotal:
+            logger.info("Sample covers most of {}. Reading all logs".format(file))
+            f.seek(0)
+            lines = [line.decode('utf-8') for line in f if len(line.strip()) > 0]
+            return lines, None, None
+
+        logger.info("Sampling {} of approx. {} logs in {}".format(sampleSize, int(estimatedTotal), file))
+        rng = random.Random(seed)
+        offsets = sorted(rng.randrange(size) for i in range(sampleSize))
+        lines = []
+        weights = []
+        for offset in offsets:
+            f.seek(findLineStart(f, offset))
+            line = f.readline()
+            if len(line.strip()) == 0:
+                continue
+            lines.append(line.decode('utf-8'))
+            weights.append(size / (sampleSize * len(line)))
+    return lines, weights, sampleSize
+
+
+def statistics_estimate(values, weights=None, draws=None, z=1.96):
+    """Estimates the number of logs per value from weighted samples, with normal \
+        approximation confidence intervals (Hansen-Hurwitz estimator)
+
+    Args:
+        values: sampled value of each log (pandas series)
+        weights: weight of each sampled log from sampleLines (None if every log was read)
+        draws: number of draws from sampleLines (defaults to the number of weights)
+        z: z score of the confidence interval (1.96 for 95%)
+
+    Returns:
+        x: pandas data frame of estimate, lower and upper bound by value
+    """
+    if weights is None:
+        counts = values.value_counts()
+        return pd.DataFrame({'estimate': counts, 'lower': counts, 'upper': counts})
+    logger.debug("calculating estimates from {} sampled logs".format(len(values)))
+    n = draws if draws is not None else len(weights)
+    w = pd.Series(weights, dtype='float64')
+    sums = pd.DataFrame({'w': w, 'w2': w ** 2}).groupby(values.reset_index(drop=True)).sum()
+    estimate = sums['w']
+    # Draws of other values (and blank draws) contribute zero to a value's estimate
+    variance = (sums['w2'] - estimate ** 2 / n) * n / (n - 1) if n > 1 else estimate * 0
+    se = variance.clip(lower=0) ** 0.5
+    x = pd.DataFrame({'estimate': estimate.round().astype('int64'),
+                      'lower': (estimate - z * se).clip(lower=0).round().astype('int64'),
+                      'upper': (estimate + z * se).round().astype('int64')})
+    x = x.sort_values('estimate', ascending=False)
+    return x
+
+
+def statistics_sample(file, fraction, seed=None):
+    """Displays estimated statistics about a GCP json log from a random sample of logs.
+
+    Args:
+        file: The file to analyse
+        fraction: approximate fraction of logs to sample
+        seed: optional random seed for repeatable samples
+
+    Returns:
+        None
+    """
+    lines, weights, draws = sampleLines(file, fraction, seed)
+    if len(lines) == 0:
+        raise Exception(logger.warning("No logs identified in {}".format(file)))
+    logs = pdFrameLines(lines)
+    sampleSize = statistics_len(logs)
+
+    # The first and last logs are read directly so sorted logs get an exact chronology
+    with open(file, 'rb') as f:
+        edges = readHeadLines(f, 1) + [readLastLine(f, os.path.getsize(file))]
+    minVal, maxVal = statistics_chronology(pd.concat([logs, pdFrameLines(edges)]))
+
+    if weights is None:
+        count = sampleSize
+    else:
+        total = statistics_estimate(pd.Series(['total'] * sampleSize), weights, draws).loc['total']
+        count = "approx. {} (95% CI {} - {}, from {} sampled logs)".format(
+            total['estimate'], total['lower'], total['upper'], sampleSize)
+    printStatistics(count,
+                    minVal,
+                    maxVal,
+                    statistics_estimate(logs['resourceType'], weights, draws),
+                    statistics_estimate(logs['account'], weights, draws),
+                    statistics_estimate(logs['severity'], weights, draws))
+
+
+class SpaceSaving:
+    """Space-Saving heavy hitter sketch. Tracks approximate counts of the most \
+        frequent values using at most capacity counters. Each count over-estimates \
+        the true count by no more than its recorded error. Sketches are mergeable.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.heap = []
+
+    def add(self, item, count=1):
+        """Counts an occurrence of a value.
+
+        Args:
+            item: value to count
+            count: number of occurrences
+
+        Returns:
+            None
+        """
+        if item in self.counts:
+            self.counts[item] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = count
+            self.errors[item] = 0
+        else:
+            minCount, minItem = self.popMin()
+            del self.counts[minItem]
+            del self.errors[minItem]
+            self.counts[item] = minCount + count
+            self.errors[item] = minCount
+        heapq.heappush(self.heap, (self.counts[item], item))
+        if len(self.heap) > self.capacity * 4:
+            self.heap = [(c, i) for i, c in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def popMin(self):
+        """Removes and returns the smallest current counter, skipping stale heap entries.
+
+        Returns:
+            minCount: smallest count
+            minItem: value with the smallest count
+        """
+        while True:
+            minCount, minItem = heapq.heappop(self.heap)
+            if self.counts.get(minItem) == minCount:
+                return minCount, minItem
+
+    def minCount(self):
+        """Calculates the count assumed for values not tracked by a full sketch.
+
+        Returns:
+            count: smallest tracked count, or 0 if the sketch is not full
+        """
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.values())
+
+    def merge(self, other):
+        """Merges another Space-Saving sketch into this sketch.
+
+        Args:
+            other: SpaceSaving sketch
+
+        Returns:
+            None
+        """
+        selfMin = self.minCount()
+        otherMin = other.minCount()
+        counts = {}
+        errors = {}
+        for item in set(self.counts) | set(other.counts):
+            counts[item] = self.counts.get(item, selfMin) + other.counts.get(item, otherMin)
+            errors[item] = self.errors.get(item, selfMin) + other.errors.get(item, otherMin)
+        keep = heapq.nlargest(max(self.capacity, other.capacity), counts, key=counts.get)
+        self.capacity = max(self.capacity, other.capacity)
+        self.counts = {item: counts[item] for item in keep}
+        self.errors = {item: errors[item] for item in keep}
+        self.heap = [(c, i) for i, c in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def top(self, n):
+        """Lists the most frequent values.
+
+        Args:
+            n: number of values to list
+
+        Returns:
+            x: array of (value, count, error) tuples, most frequent first
+        """
+        items = heapq.nlargest(n, self.counts, key=self.counts.get)
+        return [(item, self.counts[item], self.errors[item]) for item in items]
+
+
+class HyperLogLog:
+    """HyperLogLog distinct count sketch using 2^precision one byte registers. \
+        The standard error is approximately 1.04 / sqrt(2^precision). \
+        Sketches with the same precision are mergeable.
+    """
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = bytearray(2 ** precision)
+
+    def add(self, item):
+        """Adds a value to the sketch.
+
+        Args:
+            item: value to add
+
+        Returns:
+            None
+        """
+        h = int.from_bytes(hashlib.blake2b(str(item).encode('utf-8'), digest_size=8).digest(), 'big')
+        bits = 64 - self.precision
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Merges another HyperLogLog sketch into this sketch.
+
+        Args:
+            other: HyperLogLog sketch with the same precision
+
+        Returns:
+            None
+        """
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLog sketches of different precision")
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self):
+        """Estimates the number of distinct values added.
+
+        Returns:
+            x: estimated distinct count
+        """
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+def sketchLines(lines, fields, capacity=1000):
+    """Builds heavy hitter and distinct count sketches over field paths of json log lines.
+
+    Args:
+        lines: iterable of json log lines
+        fields: array of dot separated field paths
+        capacity: number of Space-Saving counters per field
+
+    Returns:
+        count: number of logs
+        sketches: dictionary of field path to (SpaceSaving, HyperLogLog) tuple
+    """
+    sketches = {}
+    for field in fields:
+        sketches[field] = (SpaceSaving(capacity), HyperLogLog())
+    count = 0
+    for line in lines:
+        log = json.loads(line)
+        count += 1
+        for field in fields:
+            value = getField(log, field)
+            if value is None:
+                value = 'no value'
+            elif not isinstance(value, str):
+                value = json.dumps(value)
+            heavyHitters, distinct = sketches[field]
+            heavyHitters.add(value)
+            distinct.add(value)
+    return count, sketches
+
+
+def mergeSketches(a, b):
+    """Merges the sketches of b into a.
+
+    Args:
+        a: dictionary of field path to (SpaceSaving, HyperLogLog) tuple
+        b: dictionary of field path to (SpaceSaving, HyperLogLog) tuple
+
+    Returns:
+        a: the merged sketches
+    """
+    for field, (heavyHitters, distinct) in b.items():
+        if field not in a:
+            a[field] = (heavyHitters, distinct)
+        else:
+            a[field][0].merge(heavyHitters)
+            a[field][1].merge(distinct)
+    return a
+
+
+def statistics_sketch(file, fields, top):
+    """Displays approximate top values and distinct counts for field paths of a \
+        GCP json log file, or every json log file in a directory, in fixed memory.
+
+    Args:
+        file: The file or directory to analyse
+        fields: array of dot separated field paths
+        top: number of most frequent values to display per field
+
+    Returns:
+        None
+    """
+    total = 0
+    sketches = {}
+    for item in getLogFiles(file):
+        logger.debug("sketching {}".format(item))
+        with open(item) as f:
+            count, fileSketches = sketchLines(f, fields, max(1000, top * 10))
+        total += count
+        sketches = mergeSketches(sketches, fileSketches)
+
+    print("---------------------")
+    print("Total log count")
+    print("---------------------")
+    print(total)
+    print("\n")
+
+    for field in fields:
+        heavyHitters, distinct = sketches.get(field, (SpaceSaving(), HyperLogLog()))
+        print("---------------------")
+        print("Top {} by {} (approx. {} distinct)".format(top, field, distinct.count()))
+        print("---------------------")
+        x = pd.DataFrame(heavyHitters.top(top), columns=[field, 'count', 'error'])
+        print(x.to_string(index=False))
+        print("\n")
+
+
+def followStatistics(file, checkpoint, interval, polls=None):
+    """Displays statistics about a growing GCP json log file or directory, \
+        refreshed whenever new logs arrive.
+
+    Args:
+        file: The file or directory to follow
+        checkpoint: checkpoint file used to resume from saved offsets and statistics (None to keep them in memory)
+        interval: seconds to wait between polls
+        polls: number of polls before returning (None to follow until interrupted)
+
+    Returns:
+        None
+    """
+    # Running totals are kept json serialisable so they are saved in the checkpoint
+    state = {'count': 0, 'minVal': None, 'maxVal': None, 'byType': {}, 'byAccount': {}, 'bySeverity': {}}
+    updated = None
+    for batch in followLogs(file, checkpoint, interval, polls, state=state):
+        if updated is None:
+            # Statistics restored from the checkpoint are shown on the first poll
+            updated = state['count'] > 0
+        if len(batch) == 0:
+            if updated is True:
+                printStatistics(state['count'],
+                                state['minVal'],
+                                state['maxVal'],
+                                getStatisticsSeries(state['byType']),
+                                getStatisticsSeries(state['byAccount']),
+                                getStatisticsSeries(state['bySeverity']))
+                updated = False
+            continue
+        logs = pdFrameLines(batch)
+        state['count'] += statistics_len(logs)
+        batchMin, batchMax = statistics_chronology(logs)
+        if state['minVal'] is None or batchMin < pd.Timestamp(state['minVal']):
+            state['minVal'] = str(batchMin)
+        if state['maxVal'] is None or batchMax > pd.Timestamp(state['maxVal']):
+            state['maxVal'] = str(batchMax)
+        for name, counts in (('byType', statistics_byType(logs)),
+                             ('byAccount', statistics_byAccount(logs)),
+                             ('bySeverity', statistics_bySeverity(logs))):
+            for value, count in counts.items():
+                state[name][value] = state[name].get(value, 0) + int(count)
+        updated = True
+
+
+def getStatisticsSeries(counts):
+    """Converts a dictionary of counts to a pandas series, largest first.
+
+    Args:
+        counts: dictionary of value to count
+
+    Returns:
+        x: pandas series of counts
+    """
+    x = pd.Series(counts, dtype='int64').sort_values(ascending=False)
+    return x
+
+
+def printStatistics(count, minVal, maxVal, byType, byAccount, bySeverity):
+    """Prints GCP json log statistics.
 
+    Args:
+        count: number of logs
+        minVal: earliest date
+        maxVal: latest date
+        byType: count of items by resourceType
+        byAccount: count of items by account
+        bySeverity: count of items by severity
+
+    Returns:
+        None
+    """
     # Total Logs
     print("---------------------")
     print("Total log count")
     print("---------------------")
-    print(statistics_len(logs))
+    print(count)
     print("\n")
 
     print("---------------------")
     print("Chronology")
     print("---------------------")
-    minVal, maxVal = statistics_chronology(logs)
     print("Oldest Log: {}".format(minVal))
     print("Most Recent Log: {}".format(maxVal))
     print("\n")
@@ -294,101 +1166,511 @@ def statistics(file):
     print("---------------------")
     print("Logs by resource.type")
     print("---------------------")
-    print(statistics_byType(logs))
+    print(byType)
     print("\n")
 
     # Logs by account
     print("---------------------")
     print("Logs by account")
     print("---------------------")
-    print(statistics_byAccount(logs))
+    print(byAccount)
     print("\n")
 
     # Logs by severity
     print("---------------------")
     print("Logs by severity")
     print("---------------------")
-    print(statistics_bySeverity(logs))
+    print(bySeverity)
     print("\n")
 
 
-def convertTimeString(s):
-    """Converts a string to a datetime object
+def loadCheckpoint(checkpoint):
+    """Reads per-file byte offsets and consumer state saved by a previous follow run.
+
+    Args:
+        checkpoint: checkpoint file path (None for no checkpoint)
+
+    Returns:
+        offsets: dictionary of file path to byte offset
+        state: dictionary of consumer state (e.g. running statistics)
+    """
+    if checkpoint is None or not os.path.isfile(checkpoint):
+        return {}, {}
+    logger.info("Resuming from checkpoint {}".format(checkpoint))
+    with open(checkpoint) as f:
+        data = json.load(f)
+    return data.get('offsets', {}), data.get('state', {})
+
+
+def saveCheckpoint(checkpoint, offsets, state=None):
+    """Saves per-file byte offsets and consumer state so a follow run can be resumed.
+
+    Args:
+        checkpoint: checkpoint file path (None for no checkpoint)
+        offsets: dictionary of file path to byte offset
+        state: json serialisable dictionary of consumer state (None for no state)
+
+    Returns:
+        None
+    """
+    if checkpoint is None:
+        return
+    tmp = checkpoint + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump({'offsets': offsets, 'state': state or {}}, f)
+    os.replace(tmp, checkpoint)
+
+
+def isCompleteLine(line):
+    """Checks whether a json log line read from the end of a file is complete. \
+        Lines ending in a newline are complete; an unterminated final line \
+        (e.g. from gcloudFormatter) is complete if it parses as json.
+
+    Args:
+        line: bytes of the line
+
+    Returns:
+        True/False
+    """
+    if line.endswith(b"\n"):
+        return True
+    try:
+        json.loads(line)
+    except ValueError:
+        return False
+    return True
+
+
+def getLogFiles(file):
+    """Lists the json log files of a file or directory.
+
+    Args:
+        file: log file or directory (searched recursively for .json files)
+
+    Returns:
+        fileList: array of files
+    """
+    if not os.path.isdir(file):
+        if os.path.isfile(file):
+            return [file]
+        return []
+    fileList = []
+    for root, dirs, files in os.walk(file):
+        for name in files:
+            if name.endswith(".json"):
+                fileList.append(os.path.join(root, name))
+    fileList.sort()
+    return fileList
+
+
+def followLogs(file, checkpoint=None, interval=5, polls=None, select=None, state=None):
+    """Polls a file or directory and yields only appended lines and new files. \
+        Offsets, and the consumer state if given, are saved to the checkpoint \
+        once each batch has been processed.
+
+    Args:
+        file: log file or directory to follow
+        checkpoint: checkpoint file path (None to keep offsets in memory)
+        interval: seconds to wait between polls
+        polls: number of polls before returning (None to follow until interrupted)
+        select: optional function of a file path returning False for files to skip
+        state: optional dictionary updated by the consumer after each batch. It \
+            is restored from and saved to the checkpoint with the offsets.
+
+    Returns:
+        Generator of arrays of json log lines. An empty array marks the end of each poll.
+    """
+    offsets, savedState = loadCheckpoint(checkpoint)
+    if state is not None:
+        state.update(savedState)
+    poll = 0
+    while True:
+        for item in getLogFiles(file):
+            if select is not None and select(item) is not True:
+                continue
+            key = os.path.abspath(item)
+            offset = offsets.get(key, 0)
+            try:
+                size = os.path.getsize(item)
+            except OSError:
+                continue
+            if size < offset:
+                logger.info("{} was truncated. Reading from the start".format(item))
+                offset = 0
+            if size == offset:
+                continue
+            with open(item, 'rb') as f:
+                f.seek(offset)
+                partial = False
+                while partial is False:
+                    lines = f.readlines(followChunkSize)
+                    if len(lines) == 0:
+                        break
+                    if not isCompleteLine(lines[-1]):
+                        # The last line is still being written. Pick it up next poll.
+                        lines.pop()
+                        partial = True
+                    if len(lines) == 0:
+                        break
+                    offset += sum(len(line) for line in lines)
+                    batch = [line.decode('utf-8') for line in lines if len(line.strip()) > 0]
+                    if len(batch) > 0:
+                        yield batch
+                    offsets[key] = offset
+                    saveCheckpoint(checkpoint, offsets, state)
+        yield []
+        poll += 1
+        if polls is not None and poll >= polls:
+            return
+        try:
+            time.sleep(interval)
+        except KeyboardInterrupt:
+            logger.info("Stopped following {}".format(file))
+            return
+
+
+def followLines(file, checkpoint=None, interval=5, select=None):
+    """Yields json log lines appended to a file or directory until interrupted.
+
+    Args:
+        file: log file or directory to follow
+        checkpoint: checkpoint file path (None to keep offsets in memory)
+        interval: seconds to wait between polls
+        select: optional function of a file path returning False for files to skip
+
+    Returns:
+        Generator of json log lines
+    """
+    logger.info("Following {} (Ctrl+C to stop)".format(file))
+    for batch in followLogs(file, checkpoint, interval, select=select):
+        for line in batch:
+            yield line
+
+
+def readLines(fileList):
+    """Yields json log lines from each file in turn.
+
+    Args:
+        fileList: array of json log files
+
+    Returns:
+        Generator of json log lines
+    """
+    for item in fileList:
+        logger.debug("reading {} line by line".format(item))
+        with open(item) as f:
+            for line in f:
+                yield line
+
+
+def convertTimeString(s):
+    """Converts a string to a datetime object
+
+    Args:
+        s: string
+
+    Returns:
+        dateTimeVal: datetime object
+    """
+    logger.debug("Converting time string {}".format(s))
+
+    try:
+        dateTimeVal = datetime.strptime(s, '%Y-%m-%d %H:%M:%S')
+        return dateTimeVal
+    except ValueError:
+        print(logger.warning("Failed to parse date/time: {}".format(s)))
+        sys.exit()
+
+
+def getTimeDeltas(dateTimeVal, size):
+    """Generates a start time an end time slice from a given datetime object
+
+    Args:
+        dateTimeVal: datetime object
+        size: time slice size in minutes
+
+    Returns:
+        startDateTime: starting datetime object of time slice
+        endDateTime: ending datetime object of time slice
+    """
+    try:
+        startDateTime = dateTimeVal - timedelta(minutes=(size/2))
+        endDateTime = dateTimeVal + timedelta(minutes=(size/2))
+        return startDateTime, endDateTime
+    except ValueError:
+        print(logger.warning("Failed to build time deltas from: {}".format(dateTimeVal)))
+        sys.exit()
+
+
+def getPartitionWindow(path):
+    """Parses the time range encoded in a cloud storage sink path. \
+        E.g. .../activity/2019/06/17/09-00-00_09-59-59_S0.json
+
+    Args:
+        path: file system path of a sink shard
+
+    Returns:
+        startDateTime: starting datetime object of the shard (None if the path is not a sink shard)
+        endDateTime: ending datetime object of the shard (None if the path is not a sink shard)
+    """
+    parts = pathlib.Path(path).parts
+    if len(parts) < 4:
+        return None, None
+    match = partitionPattern.match(parts[-1])
+    if match is None:
+        return None, None
+    try:
+        day = datetime.strptime("/".join(parts[-4:-1]), '%Y/%m/%d')
+        startDateTime = day.replace(hour=int(match.group(1)),
+                                    minute=int(match.group(2)),
+                                    second=int(match.group(3)))
+        endDateTime = day.replace(hour=int(match.group(4)),
+                                  minute=int(match.group(5)),
+                                  second=int(match.group(6)))
+    except ValueError:
+        return None, None
+    return startDateTime, endDateTime
+
+
+def partitionOverlaps(path, startDateTime, endDateTime):
+    """Checks whether a sink shard may contain logs within a given time window.
+
+    Args:
+        path: file system path of a sink shard
+        startDateTime: starting datetime object of the window
+        endDateTime: ending datetime object of the window
+
+    Returns:
+        True if the shard overlaps the window, or its path does not encode a time range
+    """
+    partStart, partEnd = getPartitionWindow(path)
+    if partStart is None:
+        return True
+    return partStart <= endDateTime and partEnd >= startDateTime
+
+
+def getTimeWindowFiles(file, startDateTime, endDateTime):
+    """Lists the files to read for a time window. A sink directory is walked \
+        recursively and shards outside the window are skipped without being opened.
+
+    Args:
+        file: log file or cloud storage sink directory
+        startDateTime: starting datetime object of the window
+        endDateTime: ending datetime object of the window
+
+    Returns:
+        fileList: array of files overlapping the window, in chronological shard order
+    """
+    return getTimeWindowsFiles(file, [(startDateTime, endDateTime)])
+
+
+def getTimeWindowsFiles(file, windows):
+    """Lists the files to read for one or more time windows. A sink directory is walked \
+        recursively and shards outside every window are skipped without being opened.
+
+    Args:
+        file: log file or cloud storage sink directory
+        windows: array of (startDateTime, endDateTime) tuples
+
+    Returns:
+        fileList: array of files overlapping a window, in chronological shard order
+    """
+    if not os.path.isdir(file):
+        return [file]
+    logger.debug("pruning sink directory {}".format(file))
+    shards = []
+    total = 0
+    for root, dirs, files in os.walk(file):
+        for name in files:
+            if not name.endswith(".json"):
+                continue
+            total += 1
+            path = os.path.join(root, name)
+            if any(partitionOverlaps(path, start, end) for start, end in windows):
+                partStart = getPartitionWindow(path)[0]
+                shards.append((partStart or datetime.max, path))
+    shards.sort()
+    fileList = [path for partStart, path in shards]
+    logger.info("Reading {} of {} files in {}".format(len(fileList), total, file))
+    return fileList
+
+
+def timeslice(file, cont, output, size, dateTimeString, partition=None, outputFormat='json', columns=None):
+    """Creates a new log file containing logs x seconds plus or minus a given timestamp.
+
+    Args:
+        file: input file or cloud storage sink directory
+        cont: True/False to accept continue prompts automatically
+        output: output file
+        size: timeline size in minutes
+        dateTimeString: datetime string to create timeslice from
+        partition: field path or time bucket template to split output by (output is then a directory)
+        outputFormat: json, csv or parquet
+        columns: array of field paths to export to csv or parquet (None to infer)
+
+    Returns:
+        None
+"""
+    dateTimeVal = convertTimeString(dateTimeString)
+    startDateTime, endDateTime = getTimeDeltas(dateTimeVal, size)
+    logger.info("Start Date/Time: {}".format(startDateTime))
+    logger.info("End Date/Time: {}".format(endDateTime))
+
+    fileList = getTimeWindowFiles(file, startDateTime, endDateTime)
+
+    continuePrompt(cont)
+
+    writer = openWriter(output, partition, outputFormat, columns)
+    try:
+        for line in readLines(fileList):
+            log = json.loads(line)
+            tmp = datetime.strptime(log['timestamp'][0:19],
+                                    '%Y-%m-%dT%H:%M:%S')
+            if tmp >= startDateTime and tmp <= endDateTime:
+                emitLog(log, output, writer)
+    finally:
+        closeWriter(writer)
+
+
+def parsePivots(pivotFile, size):
+    """Reads time windows from a file with one pivot per line. A pivot is either a \
+        datetime (yyyy-mm-dd hh:mm:ss), sliced +-size/2 minutes, or a range \
+        (yyyy-mm-dd hh:mm:ss > yyyy-mm-dd hh:mm:ss). Blank lines and # comments are ignored. \
+        Ranges that end before they start are rejected.
+
+    Args:
+        pivotFile: path to pivot file
+        size: time slice size in minutes
+
+    Returns:
+        windows: array of (startDateTime, endDateTime) tuples
+    """
+    windows = []
+    with open(pivotFile) as f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            if ">" in line:
+                tmp = line.split(">")
+                start, end = convertTimeString(tmp[0].strip()), convertTimeString(tmp[1].strip())
+                if start > end:
+                    raise Exception(logger.warning("Pivot range {} in {} ends before it starts".format(line, pivotFile)))
+                windows.append((start, end))
+            else:
+                windows.append(getTimeDeltas(convertTimeString(line), size))
+    return windows
+
+
+def mergeWindows(windows):
+    """Merges overlapping time windows into sorted, non-overlapping windows.
 
     Args:
-        s: string
+        windows: array of (startDateTime, endDateTime) tuples
 
     Returns:
-        dateTimeVal: datetime object
+        merged: sorted array of (startDateTime, endDateTime) tuples
     """
-    logger.debug("Converting time string {}".format(s))
-
-    try:
-        dateTimeVal = datetime.strptime(s, '%Y-%m-%d %H:%M:%S')
-        return dateTimeVal
-    except ValueError:
-        print(logger.warning("Failed to parse date/time: {}".format(s)))
-        sys.exit()
+    merged = []
+    for start, end in sorted(windows):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
 
 
-def getTimeDeltas(dateTimeVal, size):
-    """Generates a start time an end time slice from a given datetime object
+def findWindow(windows, starts, dateTimeVal):
+    """Finds the merged time window containing a datetime.
 
     Args:
+        windows: sorted array of non-overlapping (startDateTime, endDateTime) tuples
+        starts: array of the start datetime of each window
         dateTimeVal: datetime object
-        size: time slice size in minutes
 
     Returns:
-        startDateTime: starting datetime object of time slice
-        endDateTime: ending datetime object of time slice
+        index: index of the containing window (None if no window contains it)
     """
-    try:
-        startDateTime = dateTimeVal - timedelta(minutes=(size/2))
-        endDateTime = dateTimeVal + timedelta(minutes=(size/2))
-        return startDateTime, endDateTime
-    except ValueError:
-        print(logger.warning("Failed to build time deltas from: {}".format(dateTimeVal)))
-        sys.exit()
+    index = bisect.bisect_right(starts, dateTimeVal) - 1
+    if index >= 0 and dateTimeVal <= windows[index][1]:
+        return index
+    return None
 
 
-def timeslice(file, cont, output, size, dateTimeString):
-    """Creates a new log file containing logs x seconds plus or minus a given timestamp.
+def timesliceBatch(file, cont, output, size, pivotFile, split=False, outputFormat='json', columns=None):
+    """Creates time slices around many pivot times in a single pass. Overlapping \
+        slices are merged only to reject logs outside every slice quickly. Matching \
+        logs are written to one output, tagged with a timesliceWindows field listing \
+        every pivot window containing them, or with split to the file of each of \
+        those pivot windows in an output directory.
 
     Args:
-        file: input file
+        file: input file or cloud storage sink directory
         cont: True/False to accept continue prompts automatically
-        output: output file
-        size: timeline size in minutes
-        dateTimeString: datetime string to create timeslice from
+        output: output file, or output directory with split
+        size: time slice size in minutes for datetime pivots
+        pivotFile: file containing one pivot datetime or datetime range per line
+        split: True/False to write each pivot window to its own file
+        outputFormat: json, csv or parquet (combined output only)
+        columns: array of field paths to export to csv or parquet (None to infer)
 
     Returns:
         None
-"""
-    dateTimeVal = convertTimeString(dateTimeString)
-    startDateTime, endDateTime = getTimeDeltas(dateTimeVal, size)
-    logger.info("Start Date/Time: {}".format(startDateTime))
-    logger.info("End Date/Time: {}".format(endDateTime))
+    """
+    pivots = sorted(set(parsePivots(pivotFile, size)))
+    if len(pivots) == 0:
+        raise Exception(logger.warning("No pivots identified in {}".format(pivotFile)))
+    labels = ["{} > {}".format(start, end) for start, end in pivots]
+    for label in labels:
+        logger.info("Window: {}".format(label))
+    windows = mergeWindows(pivots)
+    starts = [start for start, end in windows]
+    # Pivot windows belonging to each merged window
+    groups = [[] for window in windows]
+    for i, (start, end) in enumerate(pivots):
+        groups[findWindow(windows, starts, start)].append(i)
+
+    fileList = getTimeWindowsFiles(file, windows)
 
     continuePrompt(cont)
 
-    with open(file) as f:
-        for line in f:
-            logger.debug("reading {} line by line".format(file))
+    if split is True:
+        writer = PartitionWriter(output, "timesliceWindow")
+    else:
+        writer = openWriter(output, None, outputFormat, columns)
+    try:
+        for line in readLines(fileList):
             log = json.loads(line)
-            tmp = datetime.strptime(log['timestamp'][0:19],
-                                    '%Y-%m-%dT%H:%M:%S')
-            if tmp >= startDateTime and tmp <= endDateTime:
-                writeOutput(log, True, output)
+            tmp = datetime.strptime(log['timestamp'][0:19], '%Y-%m-%dT%H:%M:%S')
+            index = findWindow(windows, starts, tmp)
+            if index is None:
+                continue
+            matches = [labels[i] for i in groups[index] if pivots[i][0] <= tmp <= pivots[i][1]]
+            if split is True:
+                for label in matches:
+                    writer.write(log, label.replace(" > ", "_"))
+            else:
+                log['timesliceWindows'] = matches
+                emitLog(log, output, writer)
+    finally:
+        closeWriter(writer)
 
 
-def timeframe(file, cont, output, timeframe):
+def timeframe(file, cont, output, timeframe, follow=False, checkpoint=None, interval=5, partition=None,
+              outputFormat='json', columns=None):
     """Creates a new log file containing logs between two given datetime values.
 
     Args:
-        file: input file
+        file: input file or cloud storage sink directory
         cont: True/False to accept continue prompts automatically
         output: output file
         timeframe: datetime > datetime
+        follow: True/False to keep processing logs appended to file
+        checkpoint: checkpoint file used by follow to resume from saved offsets
+        interval: seconds between follow polls
+        partition: field path or time bucket template to split output by (output is then a directory)
+        outputFormat: json, csv or parquet
+        columns: array of field paths to export to csv or parquet (None to infer)
 
     Returns:
         None
@@ -404,14 +1686,22 @@ def timeframe(file, cont, output, timeframe):
 
     logger.info("Start Date/Time: {}".format(startDateTime))
     logger.info("End Date/Time: {}".format(endDateTime))
+    if follow is True:
+        lines = followLines(file, checkpoint, interval,
+                            lambda path: partitionOverlaps(path, startDateTime, endDateTime))
+    else:
+        lines = readLines(getTimeWindowFiles(file, startDateTime, endDateTime))
     continuePrompt(cont)
 
-    with open(file) as f:
-        for line in f:
+    writer = openWriter(output, partition, outputFormat, columns)
+    try:
+        for line in lines:
             log = json.loads(line)
             tmp = datetime.strptime(log['timestamp'][0:19], '%Y-%m-%dT%H:%M:%S')
             if tmp >= startDateTime and tmp <= endDateTime:
-                writeOutput(log, True, output)
+                emitLog(log, output, writer)
+    finally:
+        closeWriter(writer)
 
 
 def getFileListing(files, recurse):
@@ -444,7 +1734,9 @@ def getFileListing(files, recurse):
 
 
 def mergeLogs(files, cont, output, recurse):
-    """Merges multiple logs from a directory (recursion supported) into one log.
+    """Merges multiple logs from a directory (recursion supported) into one log. \
+        File contents are copied without being read into memory, and a newline \
+        is added after any file that does not end with one.
 
     Args:
         file: path to evaluate
@@ -463,15 +1755,109 @@ def mergeLogs(files, cont, output, recurse):
 
     continuePrompt(cont)
     logger.info("Merging files...")
-    for item in fileList:
-        try:
-            with open(item, 'r') as i:
-                writeOutput(i.read(), False, output)
-        except OSError:
-            raise Exception(logger.warning("Error: Failed to open {}".format(item)))
+    flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+    try:
+        outFd = os.open(output, flags, 0o666)
+    except OSError:
+        raise Exception(logger.warning("Error: Failed to open {}".format(output)))
+    try:
+        end = os.lseek(outFd, 0, os.SEEK_END)
+        lastByte = b"\n"
+        if end > 0:
+            os.lseek(outFd, end - 1, os.SEEK_SET)
+            lastByte = os.read(outFd, 1)
+        for item in fileList:
+            try:
+                inFd = os.open(item, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            except OSError:
+                raise Exception(logger.warning("Error: Failed to open {}".format(item)))
+            try:
+                size = os.fstat(inFd).st_size
+                if size == 0:
+                    continue
+                if lastByte != b"\n":
+                    # Repair a missing newline so logs are not glued onto one line
+                    writeAll(outFd, b"\n")
+                copied = copyFileData(inFd, outFd, size)
+                if copied != size:
+                    raise Exception(logger.warning("Error: Copied {} of {} bytes from {}".format(copied, size, item)))
+                if copied > 0:
+                    os.lseek(inFd, copied - 1, os.SEEK_SET)
+                    lastByte = os.read(inFd, 1)
+            finally:
+                os.close(inFd)
+        if lastByte != b"\n":
+            writeAll(outFd, b"\n")
+    except OSError:
+        raise Exception(logger.warning("Error: Failed to write output"))
+    finally:
+        os.close(outFd)
     return
 
 
+def writeAll(fd, data):
+    """Writes all bytes to a file descriptor.
+
+    Args:
+        fd: file descriptor
+        data: bytes to write
+
+    Returns:
+        None
+    """
+    view = memoryview(data)
+    while len(view) > 0:
+        n = os.write(fd, view)
+        view = view[n:]
+
+
+def copyFileData(inFd, outFd, size):
+    """Copies bytes from the current position of one file descriptor to another. \
+        The copy is done in the kernel (copy_file_range, then sendfile) where \
+        supported, falling back to a fixed size buffer, so memory use does not \
+        depend on the file size.
+
+    Args:
+        inFd: input file descriptor
+        outFd: output file descriptor
+        size: number of bytes to copy
+
+    Returns:
+        copied: number of bytes copied
+    """
+    start = os.lseek(inFd, 0, os.SEEK_CUR)
+    copied = 0
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        try:
+            while copied < size:
+                count = min(size - copied, copyChunkSize)
+                if method == 'copy_file_range':
+                    n = os.copy_file_range(inFd, outFd, count)
+                else:
+                    n = os.sendfile(outFd, inFd, start + copied, count)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            if e.errno not in copyFallbackErrors:
+                raise
+            logger.debug("{} unavailable ({}). Falling back".format(method, e))
+        os.lseek(inFd, start + copied, os.SEEK_SET)
+        if copied == size:
+            return copied
+        logger.debug("{} copied {} of {} bytes. Falling back".format(method, copied, size))
+    os.lseek(inFd, start + copied, os.SEEK_SET)
+    while copied < size:
+        data = os.read(inFd, min(size - copied, copyChunkSize))
+        if len(data) == 0:
+            break
+        writeAll(outFd, data)
+        copied += len(data)
+    return copied
+
+
 def getBlobs(client, bucketId, file, cont):
     """Obtains a list of blobs in a google cloud storage directory
     Args:
@@ -491,7 +1877,7 @@ def getBlobs(client, bucketId, file, cont):
     logger.info("Identified objects")
     logger.info("-------------------")
 
-    if args.file is not None:
+    if file is not None:
         for blob in blobs:
             if fnmatch.fnmatch(blob.name, file):
                 totalSize += blob.size
@@ -582,7 +1968,8 @@ def parseFilters(filterString, filter):
     return filterList
 
 
-def filterLog(file, cont, output, filterVal, filterString):
+def filterLog(file, cont, output, filterVal, filterString, follow=False, checkpoint=None, interval=5, partition=None,
+              outputFormat='json', columns=None):
     """Filters json logs based on user provided filter parameters
     Args:
         file: path to json log file
@@ -590,16 +1977,28 @@ def filterLog(file, cont, output, filterVal, filterString):
         output: output file path
         filterVal: include or exclude
         filterString: User provided string containing filter parameters (comma separated)
+        follow: True/False to keep processing logs appended to file
+        checkpoint: checkpoint file used by follow to resume from saved offsets
+        interval: seconds between follow polls
+        partition: field path or time bucket template to split output by (output is then a directory)
+        outputFormat: json, csv or parquet
+        columns: array of field paths to export to csv or parquet (None to infer)
 
     Returns:
         None
     """
     filterList = parseFilters(filterString, filterVal)
 
+    if follow is True:
+        lines = followLines(file, checkpoint, interval)
+    else:
+        lines = readLines([file])
+
     continuePrompt(cont)
 
-    with open(file) as f:
-        for line in f:
+    writer = openWriter(output, partition, outputFormat, columns)
+    try:
+        for line in lines:
             log = json.loads(line)
             excludeCount = 0
             for item in filterList:
@@ -609,22 +2008,22 @@ def filterLog(file, cont, output, filterVal, filterString):
                     try:
                         if len(fields) == 1:
                             if log[fields[0]] == value:
-                                writeOutput(log, True, output)
+                                emitLog(log, output, writer)
                         elif len(fields) == 2:
                             if log[fields[0]][fields[1]] == value:
-                                writeOutput(log, True, output)
+                                emitLog(log, output, writer)
                         elif len(fields) == 3:
                             if log[fields[0]][fields[1]][fields[2]] == value:
-                                writeOutput(log, True, output)
+                                emitLog(log, output, writer)
                         elif len(fields) == 4:
                             if log[fields[0]][fields[1][fields[2]][fields[3]]] == value:
-                                writeOutput(log, True, output)
+                                emitLog(log, output, writer)
                         elif len(fields) == 2:
                             if log[fields[0]][fields[1]][fields[2]][fields[3]][fields[4]] == value:
-                                writeOutput(log, True, output)
+                                emitLog(log, output, writer)
                         elif len(fields) == 2:
                             if log[fields[0]][fields[1]][fields[2]][fields[3]][fields[4]][fields[5]] == value:
-                                writeOutput(log, True, output)
+                                emitLog(log, output, writer)
                     except KeyError:
                         logger.debug("Key Error at log {}".format(log['insertId']))
                         pass
@@ -651,7 +2050,625 @@ def filterLog(file, cont, output, filterVal, filterString):
                     except KeyError:
                         excludeCount += 1
             if filterString == "exclude" and excludeCount == len(filterList):
-                writeOutput(log, True, output)
+                emitLog(log, output, writer)
+    finally:
+        closeWriter(writer)
+
+
+def parseDateTime(value):
+    """Converts a datetime object or string to a datetime object, raising on failure.
+
+    Args:
+        value: datetime object or string (yyyy-mm-dd hh:mm:ss)
+
+    Returns:
+        dateTimeVal: datetime object
+    """
+    if isinstance(value, datetime):
+        return value
+    return datetime.strptime(value.strip(), '%Y-%m-%d %H:%M:%S')
+
+
+def isArrayLog(file):
+    """Checks whether a file contains an array of json objects (like that produced by 'gcloud logging read').
+
+    Args:
+        file: path to json log file
+
+    Returns:
+        True/False
+    """
+    with open(file) as f:
+        while True:
+            c = f.read(1)
+            if c == '' or not c.isspace():
+                return c == '['
+
+
+def iterArrayLogs(file):
+    """Yields json logs from an array of json objects one at a time, without \
+        reading the whole array into memory.
+
+    Args:
+        file: path to json log file
+
+    Returns:
+        Generator of json logs
+    """
+    decoder = json.JSONDecoder()
+    with open(file) as f:
+        buffer = ''
+        eof = False
+        while True:
+            buffer = buffer.lstrip(' \t\r\n[,]')
+            if buffer == '':
+                if eof:
+                    return
+                chunk = f.read(1024 * 1024)
+                eof = chunk == ''
+                buffer += chunk
+                continue
+            try:
+                log, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(1024 * 1024)
+                eof = chunk == ''
+                buffer += chunk
+                continue
+            buffer = buffer[end:]
+            yield log
+
+
+def iterLogs(source, recurse=False):
+    """Yields json logs from a json lines file, an array of json objects, a \
+        directory of json log files or a wildcard path.
+
+    Args:
+        source: file, directory or wildcard path
+        recurse: True/False value which dictates whether wildcard listings are recursive
+
+    Returns:
+        Generator of json logs
+    """
+    if os.path.exists(source):
+        fileList = getLogFiles(source)
+    else:
+        fileList = getFileListing(source, recurse)
+    for item in fileList:
+        if isArrayLog(item):
+            for log in iterArrayLogs(item):
+                yield log
+        else:
+            for line in readLines([item]):
+                if line.strip() != '':
+                    yield json.loads(line)
+
+
+def iterBlobLogs(bucketId, file=None, client=None):
+    """Yields json logs from json lines objects in a google cloud storage bucket, \
+        streamed without downloading them to disk.
+
+    Args:
+        bucketId: GCP bucket ID
+        file: path filter. E.g. *2019* (None for all objects)
+        client: GCP client object (None to create one from the default configuration)
+
+    Returns:
+        Generator of json logs
+    """
+    if client is None:
+        client = storage.Client()
+    for blob in client.list_blobs(bucketId):
+        if file is not None and not fnmatch.fnmatch(blob.name, file):
+            continue
+        logger.debug("reading {} from {}".format(blob.name, bucketId))
+        with blob.open('rt') as f:
+            for line in f:
+                if line.strip() != '':
+                    yield json.loads(line)
+
+
+def filterLogs(logs, filters, filterString="include"):
+    """Yields json logs matching (include) or not matching (exclude) any of the filter conditions.
+
+    Args:
+        logs: iterable of json logs
+        filters: filter string (e.g. "severity=ERROR,resource.type=gce_instance") or array of [field path, value]
+        filterString: include or exclude
+
+    Returns:
+        Generator of json logs
+    """
+    if isinstance(filters, str):
+        filters = parseFilters(filterString, filters)
+    conditions = [(item[0].strip(), item[1].strip()) for item in filters]
+    for log in logs:
+        match = False
+        for field, value in conditions:
+            if getField(log, field) == value:
+                match = True
+                break
+        if match is (filterString == "include"):
+            yield log
+
+
+def timeWindowLogs(logs, startDateTime, endDateTime):
+    """Yields json logs with a timestamp between two datetime values (inclusive).
+
+    Args:
+        logs: iterable of json logs
+        startDateTime: datetime object or string (yyyy-mm-dd hh:mm:ss)
+        endDateTime: datetime object or string (yyyy-mm-dd hh:mm:ss)
+
+    Returns:
+        Generator of json logs
+    """
+    startDateTime = parseDateTime(startDateTime)
+    endDateTime = parseDateTime(endDateTime)
+    for log in logs:
+        try:
+            tmp = datetime.strptime(log['timestamp'][0:19], '%Y-%m-%dT%H:%M:%S')
+        except (KeyError, ValueError):
+            continue
+        if tmp >= startDateTime and tmp <= endDateTime:
+            yield log
+
+
+def aggregateLogs(logs, fields):
+    """Counts json logs by the values of field paths.
+
+    Args:
+        logs: iterable of json logs
+        fields: array of dot separated field paths
+
+    Returns:
+        count: number of logs
+        x: dictionary of field path to collections.Counter of values
+    """
+    x = {}
+    for field in fields:
+        x[field] = collections.Counter()
+    count = 0
+    for log in logs:
+        count += 1
+        for field in fields:
+            value = getField(log, field)
+            if value is None:
+                value = 'no value'
+            elif not isinstance(value, str):
+                value = json.dumps(value)
+            x[field][value] += 1
+    return count, x
+
+
+def writeLogs(logs, output, partition=None, outputFormat='json', columns=None):
+    """Writes json logs to an output file, or to partition files in an output directory.
+
+    Args:
+        logs: iterable of json logs
+        output: output file, or output directory when partitioning
+        partition: field path or time bucket template (None for a single output file)
+        outputFormat: json, csv or parquet
+        columns: array of field paths to export to csv or parquet (None to infer)
+
+    Returns:
+        count: number of logs written
+    """
+    writer = openWriter(output, partition, outputFormat, columns)
+    count = 0
+    if writer is None:
+        try:
+            with open(output, 'a') as o:
+                for log in logs:
+                    json.dump(log, o)
+                    o.write("\n")
+                    count += 1
+        except OSError:
+            raise Exception(logger.warning("Error: Failed to write output"))
+    else:
+        try:
+            for log in logs:
+                writer.write(log)
+                count += 1
+        finally:
+            closeWriter(writer)
+    return count
+
+
+def exportLogs(file, output, outputFormat, columns=None, recurse=False):
+    """Streams json logs into a flattened csv or parquet file for timeline tooling.
+
+    Args:
+        file: json log file, array of json objects, directory or wildcard path
+        output: output file path
+        outputFormat: csv or parquet
+        columns: array of field paths to export (None to infer)
+        recurse: True/False value which dictates whether wildcard listings are recursive
+
+    Returns:
+        count: number of logs exported
+    """
+    count = writeLogs(iterLogs(file, recurse), output, None, outputFormat, columns)
+    logger.info("Exported {} logs to {}".format(count, output))
+    return count
+
+
+def openIndex(db):
+    """Opens (creating if required) a sqlite field index database.
+
+    Args:
+        db: index database path
+
+    Returns:
+        connection: sqlite3 connection
+    """
+    connection = sqlite3.connect(db)
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, indexed INTEGER,
+                                          inode TEXT, fingerprint TEXT);
+        CREATE TABLE IF NOT EXISTS fields (field TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS entries (field TEXT, value TEXT, file INTEGER, offset INTEGER);
+        CREATE INDEX IF NOT EXISTS entries_lookup ON entries (field, value);
+    """)
+    return connection
+
+
+def getFileFingerprint(f, length):
+    """Hashes the first bytes of a file, so a file regenerated in place can be told \
+        apart from the same file with logs appended.
+
+    Args:
+        f: binary file object
+        length: number of indexed bytes
+
+    Returns:
+        fingerprint: hash of the first min(length, 4096) bytes, prefixed by that length
+    """
+    length = min(length, 4096)
+    f.seek(0)
+    return "{}:{}".format(length, hashlib.sha1(f.read(length)).hexdigest())
+
+
+def getIndexValue(log, field):
+    """Reads the value of a field as stored in the index.
+
+    Args:
+        log: json log
+        field: dot separated field path
+
+    Returns:
+        value: field value as a string (None if the field is not present)
+    """
+    value = getField(log, field)
+    if value is not None and not isinstance(value, str):
+        value = json.dumps(value)
+    return value
+
+
+def getIndexFiles(files, recurse):
+    """Lists the json log files to index.
+
+    Args:
+        files: file, directory or wildcard path
+        recurse: True/False value which dictates whether wildcard listings are recursive
+
+    Returns:
+        fileList: array of files
+    """
+    if os.path.exists(files):
+        return getLogFiles(files)
+    return getFileListing(files, recurse)
+
+
+def buildIndex(files, recurse, db, fields):
+    """Builds or incrementally updates an index of field values to (file, offset). \
+        Only bytes appended since the last run and new files are read. Changing \
+        the indexed fields causes a full re-index. A file is re-indexed if it \
+        shrinks, is replaced (new inode), or its first bytes change.
+
+    Args:
+        files: file, directory or wildcard path
+        recurse: True/False value which dictates whether wildcard listings are recursive
+        db: index database path
+        fields: array of dot separated field paths to index
+
+    Returns:
+        count: number of index entries added
+    """
+    connection = openIndex(db)
+    indexedFields = sorted(row[0] for row in connection.execute("SELECT field FROM fields"))
+    if indexedFields != sorted(fields):
+        if len(indexedFields) > 0:
+            logger.info("Indexed fields changed from {}. Rebuilding index".format(",".join(indexedFields)))
+        connection.execute("DELETE FROM entries")
+        connection.execute("DELETE FROM fields")
+        connection.execute("UPDATE files SET indexed = 0")
+        connection.executemany("INSERT INTO fields (field) VALUES (?)", [(field,) for field in fields])
+        connection.commit()
+
+    count = 0
+    for item in getIndexFiles(files, recurse):
+        path = os.path.abspath(item)
+        stat = os.stat(item)
+        size = stat.st_size
+        inode = "{}:{}".format(stat.st_dev, stat.st_ino)
+        row = connection.execute("SELECT id, indexed, inode, fingerprint FROM files WHERE path = ?",
+                                 (path,)).fetchone()
+        if row is None:
+            fileId = connection.execute("INSERT INTO files (path, indexed) VALUES (?, 0)", (path,)).lastrowid
+            offset = 0
+            fingerprint = None
+        else:
+            fileId, offset, indexedInode, fingerprint = row
+        with open(item, 'rb') as f:
+            if offset > 0 and (size < offset or inode != indexedInode or
+                               getFileFingerprint(f, offset) != fingerprint):
+                logger.info("{} was truncated or replaced. Re-indexing".format(item))
+                connection.execute("DELETE FROM entries WHERE file = ?", (fileId,))
+                offset = 0
+            if size == offset:
+                continue
+            logger.info("Indexing {} from byte {}".format(item, offset))
+            entries = []
+            f.seek(offset)
+            for line in f:
+                if not isCompleteLine(line):
+                    # The last line is still being written. Index it next run.
+                    break
+                if len(line.strip()) > 0:
+                    log = json.loads(line)
+                    for field in fields:
+                        value = getIndexValue(log, field)
+                        if value is None:
+                            continue
+                        entries.append((field, value, fileId, offset))
+                offset += len(line)
+                if len(entries) >= 10000:
+                    connection.executemany("INSERT INTO entries VALUES (?, ?, ?, ?)", entries)
+                    count += len(entries)
+                    entries = []
+            fingerprint = getFileFingerprint(f, offset)
+        connection.executemany("INSERT INTO entries VALUES (?, ?, ?, ?)", entries)
+        count += len(entries)
+        connection.execute("UPDATE files SET indexed = ?, inode = ?, fingerprint = ? WHERE id = ?",
+                           (offset, inode, fingerprint, fileId))
+        connection.commit()
+    connection.close()
+    logger.info("Added {} index entries to {}".format(count, db))
+    return count
+
+
+def iterLookupLogs(db, field, value):
+    """Yields json logs with a given field value by seeking straight to their index offsets. \
+        Entries that no longer match the file, or whose file has been moved or deleted \
+        (a stale index), are skipped with a warning.
+
+    Args:
+        db: index database path
+        field: dot separated field path (must be indexed)
+        value: field value
+
+    Returns:
+        Generator of json logs
+    """
+    connection = openIndex(db)
+    indexedFields = [row[0] for row in connection.execute("SELECT field FROM fields")]
+    if field not in indexedFields:
+        connection.close()
+        raise Exception(logger.warning("{} is not indexed in {}".format(field, db)))
+    rows = connection.execute("""SELECT files.path, entries.offset FROM entries
+                                 JOIN files ON files.id = entries.file
+                                 WHERE entries.field = ? AND entries.value = ?
+                                 ORDER BY files.path, entries.offset""", (field, value)).fetchall()
+    connection.close()
+    f = None
+    current = None
+    stale = 0
+    try:
+        for path, offset in rows:
+            if path != current:
+                if f is not None:
+                    f.close()
+                    f = None
+                current = path
+                try:
+                    f = open(path, 'rb')
+                except OSError:
+                    logger.warning("Unable to open indexed file {}".format(path))
+            if f is None:
+                stale += 1
+                continue
+            f.seek(offset)
+            try:
+                log = json.loads(f.readline())
+            except ValueError:
+                log = None
+            if not isinstance(log, dict) or getIndexValue(log, field) != value:
+                stale += 1
+                continue
+            yield log
+    finally:
+        if f is not None:
+            f.close()
+        if stale > 0:
+            logger.warning("Skipped {} stale index entries. Run --index again to update {}".format(stale, db))
+
+
+def lookupLogs(db, lookup, output):
+    """Writes json logs matching a field=value lookup from an index to an output file.
+
+    Args:
+        db: index database path
+        lookup: field=value string
+        output: output file path
+
+    Returns:
+        count: number of logs written
+    """
+    try:
+        field, value = lookup.split("=", 1)
+    except ValueError:
+        raise Exception(logger.warning("Lookup should be in the format field=value"))
+    count = 0
+    for log in iterLookupLogs(db, field.strip(), value.strip()):
+        writeOutput(log, True, output)
+        count += 1
+    logger.info("Found {} logs".format(count))
+    return count
+
+
+def sortKey(value):
+    """Builds a type tagged sort key for a json field value. Numbers compare \
+        numerically and timestamps are normalised to nanosecond precision so \
+        that they sort chronologically; other strings compare as text. Values \
+        of different types sort in the order: missing, booleans, numbers, \
+        timestamps, strings, objects and arrays.
+
+    Args:
+        value: json field value (None if missing)
+
+    Returns:
+        key: sort key tuple of (type tag, comparable value)
+    """
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, int(value))
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        match = timestampPattern.match(value)
+        if match is not None:
+            return (3, match.group(1) + (match.group(2) or '.').ljust(10, '0'))
+        return (4, value)
+    return (5, json.dumps(value, sort_keys=True))
+
+
+def writeSortRun(records, tempdir):
+    """Sorts records and writes them to a temporary run file as key, tab, raw line.
+
+    Args:
+        records: array of (key, line) tuples
+        tempdir: temporary directory (None for the system default)
+
+    Returns:
+        path: run file path
+    """
+    records.sort(key=lambda record: record[0])
+    fd, path = tempfile.mkstemp(suffix=".run", prefix="gcp_log_toolbox_", dir=tempdir)
+    logger.debug("writing sorted run of {} logs to {}".format(len(records), path))
+    with os.fdopen(fd, 'wb') as f:
+        for key, line in records:
+            f.write(json.dumps(key).encode('utf-8'))
+            f.write(b"\t")
+            f.write(line)
+    return path
+
+
+def readSortRun(path):
+    """Yields records from a run file written by writeSortRun.
+
+    Args:
+        path: run file path
+
+    Returns:
+        Generator of (key, line) tuples
+    """
+    with open(path, 'rb') as f:
+        for record in f:
+            key, line = record.split(b"\t", 1)
+            yield tuple(json.loads(key)), line
+
+
+def mergeSortRuns(runs, tempdir):
+    """Merges run files into one run file, removing the merged runs.
+
+    Args:
+        runs: array of run file paths
+        tempdir: temporary directory (None for the system default)
+
+    Returns:
+        path: merged run file path
+    """
+    fd, path = tempfile.mkstemp(suffix=".run", prefix="gcp_log_toolbox_", dir=tempdir)
+    logger.debug("merging {} sorted runs to {}".format(len(runs), path))
+    with os.fdopen(fd, 'wb') as f:
+        for key, line in heapq.merge(*[readSortRun(run) for run in runs], key=lambda record: record[0]):
+            f.write(json.dumps(key).encode('utf-8'))
+            f.write(b"\t")
+            f.write(line)
+    for run in runs:
+        os.remove(run)
+    return path
+
+
+def sortLogs(file, output, field='timestamp', memory=512, tempdir=None):
+    """Sorts json logs by a field using sorted runs spilled to disk and a k-way merge. \
+        Logs are kept as raw bytes and are not re-serialized.
+
+    Args:
+        file: json log file or directory
+        output: output file path
+        field: dot separated field path to sort by
+        memory: approximate memory budget in megabytes
+        tempdir: directory for sorted runs (None for the system default)
+
+    Returns:
+        count: number of logs sorted
+    """
+    budget = memory * 1024 * 1024
+    runs = []
+    records = []
+    size = 0
+    count = 0
+    try:
+        for item in getLogFiles(file):
+            logger.debug("reading {} line by line".format(item))
+            with open(item, 'rb') as f:
+                for line in f:
+                    if len(line.strip()) == 0:
+                        continue
+                    if not line.endswith(b"\n"):
+                        line += b"\n"
+                    key = sortKey(getField(json.loads(line), field))
+                    records.append((key, line))
+                    count += 1
+                    size += len(line) + len(str(key[1])) + sortRecordOverhead
+                    if size >= budget:
+                        runs.append(writeSortRun(records, tempdir))
+                        records = []
+                        size = 0
+
+        try:
+            o = open(output, 'ab')
+        except OSError:
+            raise Exception(logger.warning("Error: Failed to open {}".format(output)))
+        with o:
+            if len(runs) == 0:
+                records.sort(key=lambda record: record[0])
+                for key, line in records:
+                    o.write(line)
+            else:
+                if len(records) > 0:
+                    runs.append(writeSortRun(records, tempdir))
+                    records = []
+                logger.info("Merging {} sorted runs".format(len(runs)))
+                while len(runs) > sortMergeWidth:
+                    # Merge in passes so the number of open run files stays bounded
+                    runs = [mergeSortRuns(runs[i:i + sortMergeWidth], tempdir)
+                            for i in range(0, len(runs), sortMergeWidth)]
+                for key, line in heapq.merge(*[readSortRun(run) for run in runs], key=lambda record: record[0]):
+                    o.write(line)
+    finally:
+        for run in runs:
+            try:
+                os.remove(run)
+            except OSError:
+                logger.warning("Failed to remove temporary file {}".format(run))
+    logger.info("Sorted {} logs by {} to {}".format(count, field, output))
+    return count
 
 
 def gcloudFormatter(file, output):
@@ -718,6 +2735,15 @@ def downloadStackdriver():
             --------------------------------------")
 
 logger = logging.getLogger(__name__) # 'root' Logger
+followChunkSize = 8 * 1024 * 1024
+copyChunkSize = 64 * 1024 * 1024
+copyFallbackErrors = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF,
+                      errno.EOPNOTSUPP, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)}
+partitionBufferSize = 64 * 1024
+sortRecordOverhead = 150
+sortMergeWidth = 128
+timestampPattern = re.compile(r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(\.\d{1,9})?Z$')
+partitionPattern = re.compile(r'^(\d{2})-(\d{2})-(\d{2})_(\d{2})-(\d{2})-(\d{2})_S\d+\.json$')
 
 if __name__ == "__main__":
     # Argument setup
@@ -735,12 +2761,33 @@ if __name__ == "__main__":
             ./log.json", action="store_true")
     task.add_argument("--timeslice", help='Create a time slice around a specific\
         datetime. Usage: gcp_log_toolbox.py --timeslice "yyyy-mm-dd hh:mm:ss" \
-            -f ./log.json -s 60 -o ./output.json')
+            -f ./log.json -s 60 -o ./output.json. -f also accepts a cloud \
+                storage sink directory')
+    task.add_argument("--timeslicebatch", help='Create time slices around \
+        every pivot in a file (one "yyyy-mm-dd hh:mm:ss" or "yyyy-mm-dd hh:mm:ss \
+            > yyyy-mm-dd hh:mm:ss" per line) in a single pass. Usage: \
+                gcp_log_toolbox.py --timeslicebatch ./pivots.txt -f ./log.json \
+                    -s 60 -o ./output.json')
     task.add_argument("--timeframe", help='Filter logs between two specified \
         dates. Usage: gcp_log_toolbox.py --timeframe "yyyy-mm-dd hh:mm:ss - \
-            yyyy-mm-dd hh:mm:ss" -f ./log.json -o ./output.json')
+            yyyy-mm-dd hh:mm:ss" -f ./log.json -o ./output.json. -f also \
+                accepts a cloud storage sink directory')
     task.add_argument("--filter", help='Filter existing log file to exclude or \
         include logs of a specified resource.type', choices=['include', 'exclude'])
+    task.add_argument("--export", help='Export logs to a flattened csv or \
+        parquet file with one column per json field path. Usage: \
+            gcp_log_toolbox.py --export csv -f ./log.json -o ./output.csv', choices=['csv', 'parquet'])
+    task.add_argument("--index", help="Build or update a persistent index of \
+        json field values. Usage: gcp_log_toolbox.py --index -f ./logdir -t \
+            insertId,protoPayload.authenticationInfo.principalEmail --db \
+                ./index.db", action="store_true")
+    task.add_argument("--lookup", help='Write logs with a field value from an \
+        index. Usage: gcp_log_toolbox.py --lookup "insertId=abc123" --db \
+            ./index.db -o ./output.json')
+    task.add_argument("--sort", help="Sort logs by timestamp, or by another \
+        json field path, using sorted runs on disk for files larger than \
+            memory. Usage: gcp_log_toolbox.py --sort -f ./merged.json -o \
+                ./sorted.json --memory 1024", nargs="?", const="timestamp")
     task.add_argument("--gcloudformatter", help='Convert gcloud logging read \
         output (array of json) to gcp_log_toolbox format (single line compressed\
             json)', action="store_true", default=False)
@@ -759,16 +2806,53 @@ if __name__ == "__main__":
         minutes", type=int, default=30)
     parser.add_argument("-t", "--type", help="Json values to include or exclude\
         from log. Supports comma separation for multiple values. For use with \
-            'filter' function.")
+            'filter' function. Field paths to index for 'index' function.")
+    parser.add_argument("--memory", help="Approximate memory budget in MB for \
+        --sort", type=int, default=512)
+    parser.add_argument("--tempdir", help="Directory for --sort temporary \
+        files (defaults to the system temporary directory)")
+    parser.add_argument("--db", help="Path to index database. Used for index \
+        and lookup.")
     parser.add_argument("-k", "--key", help="path to json key file \
         (for authentication).")
     parser.add_argument("--acceptall", help="Accept all prompts without \
         user input", action="store_true", default=False)
+    parser.add_argument("--follow", help="Keep watching the file or directory \
+        and process appended logs and new files until interrupted. Used for \
+            statistics, timeframe and filter.", action="store_true", default=False)
+    parser.add_argument("--checkpoint", help="Checkpoint file of per-file \
+        offsets, so a --follow run resumes where it stopped.")
+    parser.add_argument("--interval", help="Seconds between --follow \
+        polls", type=float, default=5)
+    parser.add_argument("--sample", help="Estimate statistics from a random \
+        sample of this fraction of logs (e.g. 0.01) read at random offsets, \
+            instead of reading the whole file. Used for statistics.", type=float)
+    parser.add_argument("--sketch", help="Report approximate top values and \
+        distinct counts for comma separated json field paths in fixed memory \
+            (e.g. protoPayload.methodName,protoPayload.requestMetadata.callerIp). \
+                -f may be a directory. Used for statistics.")
+    parser.add_argument("--top", help="Number of top values reported by \
+        --sketch", type=int, default=10)
+    parser.add_argument("--split", help="Write each --timeslicebatch window \
+        to its own file. -o is then an output directory.", action="store_true",
+        default=False)
+    parser.add_argument("--format", help="Output format of timeslice, \
+        timeslicebatch, timeframe and filter. csv and parquet are flattened \
+            (parquet requires pyarrow).", choices=['json', 'csv', 'parquet'], default='json')
+    parser.add_argument("--columns", help="Comma separated json field paths to \
+        export as columns with --export or --format (inferred if not set)")
+    parser.add_argument("-p", "--partition", help="Split output into one file \
+        per value of a json field (e.g. resource.type) or per time bucket \
+            (e.g. %%Y-%%m-%%d_%%H). -o is then an output directory. Used for \
+                timeslice, timeframe and filter.")
     parser.add_argument("-v", "--verbose", help="Verbose logs \
         ", action="store_true", default=False)
     args = parser.parse_args()
 
     validateArgs(args)
+    columns = None
+    if args.columns is not None:
+        columns = [c.strip() for c in args.columns.split(",")]
 
     console = logging.StreamHandler()
     logger.addHandler(console) # prints to console.
@@ -778,13 +2862,27 @@ if __name__ == "__main__":
         logger.setLevel(logging.INFO)
 
     if args.statistics is True:
-        statistics(args.file)
+        if args.follow is True:
+            followStatistics(args.file, args.checkpoint, args.interval)
+        elif args.sample is not None:
+            statistics_sample(args.file, args.sample)
+        elif args.sketch is not None:
+            statistics_sketch(args.file, [f.strip() for f in args.sketch.split(",")], args.top)
+        else:
+            statistics(args.file)
 
     if args.timeslice is not None:
-        timeslice(args.file, args.acceptall, args.output, args.size, args.timeslice)
+        timeslice(args.file, args.acceptall, args.output, args.size, args.timeslice,
+                  args.partition, args.format, columns)
+
+    if args.timeslicebatch is not None:
+        timesliceBatch(args.file, args.acceptall, args.output, args.size, args.timeslicebatch,
+                       args.split, args.format, columns)
 
     if args.timeframe is not None:
-        timeframe(args.file, args.acceptall, args.output, args.timeframe)
+        timeframe(args.file, args.acceptall, args.output, args.timeframe,
+                  args.follow, args.checkpoint, args.interval, args.partition,
+                  args.format, columns)
 
     if args.merge is True:
         mergeLogs(args.file, args.acceptall, args.output, args.recurse)
@@ -796,7 +2894,21 @@ if __name__ == "__main__":
         downloadStackdriver()
 
     if args.filter is not None:
-        filterLog(args.file, args.acceptall, args.output, args.type, args.filter)
+        filterLog(args.file, args.acceptall, args.output, args.type, args.filter,
+                  args.follow, args.checkpoint, args.interval, args.partition,
+                  args.format, columns)
+
+    if args.export is not None:
+        exportLogs(args.file, args.output, args.export, columns, args.recurse)
+
+    if args.index is True:
+        buildIndex(args.file, args.recurse, args.db, [t.strip() for t in args.type.split(",")])
+
+    if args.lookup is not None:
+        lookupLogs(args.db, args.lookup, args.output)
+
+    if args.sort is not None:
+        sortLogs(args.file, args.output, args.sort, args.memory, args.tempdir)
 
     if args.gcloudformatter is True:
         gcloudFormatter(args.file, args.output)
@@ -1,4 +1,6 @@
 import os
+import csv
+import json
 import gcp_log_toolbox
 from datetime import datetime
 
@@ -119,3 +121,523 @@ def test_gcloudformatter():
 
     os.remove("./unit_test_logs/gcloudformatter_tmp.json")
     assert len(content) == 555
+
+
+def test_getPartitionWindow():
+    startVal, endVal = gcp_log_toolbox.getPartitionWindow("./unit_test_logs/cloud_storage_sink/cloudaudit.googleapis.com/activity/2019/06/17/09-00-00_09-59-59_S1.json")
+    assert startVal == datetime.strptime("2019-06-17 09:00:00", '%Y-%m-%d %H:%M:%S')
+    assert endVal == datetime.strptime("2019-06-17 09:59:59", '%Y-%m-%d %H:%M:%S')
+    assert gcp_log_toolbox.getPartitionWindow("./unit_test_logs/json_lines_small.json") == (None, None)
+
+
+def test_timeframe_sink_directory():
+    startVal = datetime.strptime("2019-06-17 09:00:00", '%Y-%m-%d %H:%M:%S')
+    endVal = datetime.strptime("2019-06-17 14:30:00", '%Y-%m-%d %H:%M:%S')
+    fileList = gcp_log_toolbox.getTimeWindowFiles("./unit_test_logs/cloud_storage_sink", startVal, endVal)
+    assert len(fileList) == 8
+
+    gcp_log_toolbox.timeframe("./unit_test_logs/cloud_storage_sink",
+                              True,
+                              "./unit_test_logs/timeframe_tmp.json",
+                              "2019-06-17 09:00:00 > 2019-06-17 14:30:00")
+    with open("./unit_test_logs/timeframe_tmp.json") as f:
+        content = f.readlines()
+
+    os.remove("./unit_test_logs/timeframe_tmp.json")
+    assert len(content) > 0
+    for line in content:
+        assert "2019-06-17T09:00:00" <= json.loads(line)['timestamp'] <= "2019-06-17T14:30:01"
+
+
+def test_followLogs_checkpoint():
+    with open("./unit_test_logs/json_lines_small.json") as f:
+        content = f.readlines()
+    with open("./unit_test_logs/follow_tmp.json", "w") as o:
+        o.writelines(content[:10])
+        o.write(content[10][:20])
+
+    batches = list(gcp_log_toolbox.followLogs("./unit_test_logs/follow_tmp.json", "./unit_test_logs/follow_tmp.checkpoint", 0, 1))
+    assert sum(len(b) for b in batches) == 10
+    assert batches[-1] == []
+
+    with open("./unit_test_logs/follow_tmp.json", "a") as o:
+        o.write(content[10][20:])
+        o.writelines(content[11:20])
+
+    batches = list(gcp_log_toolbox.followLogs("./unit_test_logs/follow_tmp.json", "./unit_test_logs/follow_tmp.checkpoint", 0, 1))
+    lines = [line for b in batches for line in b]
+    os.remove("./unit_test_logs/follow_tmp.json")
+    os.remove("./unit_test_logs/follow_tmp.checkpoint")
+    assert lines == content[10:20]
+
+
+def test_getField():
+    log = {"protoPayload": {"authenticationInfo": {"principalEmail": "test@testdomain.com"}}, "severity": "NOTICE"}
+    assert gcp_log_toolbox.getField(log, "severity") == "NOTICE"
+    assert gcp_log_toolbox.getField(log, "protoPayload.authenticationInfo.principalEmail") == "test@testdomain.com"
+    assert gcp_log_toolbox.getField(log, "resource.type") is None
+
+
+def test_PartitionWriter():
+    writer = gcp_log_toolbox.PartitionWriter("./unit_test_logs/partition_tmp", "resource.type", maxOpen=2)
+    with open("./unit_test_logs/json_lines_small.json") as f:
+        for line in f:
+            writer.write(json.loads(line))
+    writer.close()
+
+    fileList = os.listdir("./unit_test_logs/partition_tmp")
+    count = 0
+    for name in fileList:
+        with open(os.path.join("./unit_test_logs/partition_tmp", name)) as f:
+            for line in f:
+                count += 1
+                assert json.loads(line)['resource']['type'] + ".json" == name
+        os.remove(os.path.join("./unit_test_logs/partition_tmp", name))
+    os.rmdir("./unit_test_logs/partition_tmp")
+    assert len(fileList) == 13
+    assert count == 555
+
+
+def test_sampleLines():
+    lines, weights, draws = gcp_log_toolbox.sampleLines("./unit_test_logs/json_lines_small.json", 0.1, seed=1)
+    assert 0 < len(lines) < 100
+    assert len(weights) == len(lines) == draws
+    assert 400 < sum(weights) < 700
+    for line in lines:
+        assert 'insertId' in json.loads(line)
+    lines, weights, draws = gcp_log_toolbox.sampleLines("./unit_test_logs/json_lines_small.json", 1)
+    assert len(lines) == 555
+    assert weights is None
+
+
+def test_statistics_estimate():
+    data = gcp_log_toolbox.pdFrame("./unit_test_logs/json_lines_small.json")
+    tmpVal = gcp_log_toolbox.statistics_estimate(data['severity'])
+    assert len(tmpVal) == 5
+    assert tmpVal['estimate'].sum() == 555
+    assert (tmpVal['lower'] == tmpVal['upper']).all()
+
+
+def test_statistics_estimate_accuracy():
+    data = gcp_log_toolbox.pdFrame("./unit_test_logs/json_lines_small.json")
+    expected = gcp_log_toolbox.statistics_byType(data)
+    runs = 100
+    means = {}
+    covered = {}
+    for seed in range(runs):
+        lines, weights, draws = gcp_log_toolbox.sampleLines("./unit_test_logs/json_lines_small.json", 0.3, seed=seed)
+        tmpVal = gcp_log_toolbox.statistics_estimate(gcp_log_toolbox.pdFrameLines(lines)['resourceType'], weights, draws)
+        for resourceType in ["k8s_cluster", "gce_instance", "gcs_bucket"]:
+            estimate, lower, upper = tmpVal.loc[resourceType] if resourceType in tmpVal.index else (0, 0, 0)
+            means[resourceType] = means.get(resourceType, 0) + estimate / runs
+            covered[resourceType] = covered.get(resourceType, 0) + (lower <= expected[resourceType] <= upper)
+    for resourceType in means:
+        assert abs(means[resourceType] - expected[resourceType]) < 0.1 * expected[resourceType]
+        assert covered[resourceType] >= 0.85 * runs
+
+
+def test_sampleLines_blank():
+    with open("./unit_test_logs/json_lines_small.json") as f:
+        logs = [line for line in f if len(line.strip()) > 0]
+    with open("./unit_test_logs/sample_blank_tmp.json", "w") as f:
+        for line in logs:
+            f.write(line + " " * 300 + "\n")
+    runs = 100
+    mean = 0
+    for seed in range(runs):
+        lines, weights, draws = gcp_log_toolbox.sampleLines("./unit_test_logs/sample_blank_tmp.json", 0.2, seed=seed)
+        assert len(lines) < draws
+        mean += sum(weights) / runs
+    os.remove("./unit_test_logs/sample_blank_tmp.json")
+    assert abs(mean - len(logs)) < 0.1 * len(logs)
+
+
+def test_SpaceSaving():
+    a = gcp_log_toolbox.SpaceSaving(3)
+    b = gcp_log_toolbox.SpaceSaving(3)
+    for item in ["x"] * 50 + ["y"] * 20 + ["z%d" % i for i in range(30)]:
+        a.add(item)
+    for item in ["x"] * 10 + ["w"] * 30:
+        b.add(item)
+    assert a.top(1)[0][0] == "x"
+    a.merge(b)
+    top = a.top(2)
+    assert top[0][0] == "x" and top[0][1] - top[0][2] <= 60 <= top[0][1]
+    assert top[1][0] == "w"
+
+
+def test_HyperLogLog():
+    a = gcp_log_toolbox.HyperLogLog()
+    b = gcp_log_toolbox.HyperLogLog()
+    for i in range(5000):
+        a.add("user%d@testdomain.com" % i)
+        b.add("user%d@testdomain.com" % (i + 2500))
+    assert 4800 < a.count() < 5200
+    a.merge(b)
+    assert 7200 < a.count() < 7800
+
+
+def test_sketchLines():
+    with open("./unit_test_logs/json_lines_small.json") as f:
+        count, sketches = gcp_log_toolbox.sketchLines(f, ["resource.type", "protoPayload.authenticationInfo.principalEmail"])
+    assert count == 555
+    assert sketches["resource.type"][1].count() == 13
+    assert len(sketches["protoPayload.authenticationInfo.principalEmail"][0].top(10)) == 5
+
+
+def test_iterLogs():
+    arrayLogs = list(gcp_log_toolbox.iterLogs("./unit_test_logs/gcloud_array_small.json"))
+    lineLogs = list(gcp_log_toolbox.iterLogs("./unit_test_logs/json_lines_small.json"))
+    sinkLogs = list(gcp_log_toolbox.iterLogs("./unit_test_logs/cloud_storage_sink"))
+    assert len(arrayLogs) == len(lineLogs) == 555
+    assert arrayLogs[0] == gcp_log_toolbox.readLog("./unit_test_logs/gcloud_array_small.json")[0]
+    assert len(sinkLogs) == 291
+
+
+def test_library_pipeline():
+    logs = gcp_log_toolbox.iterLogs("./unit_test_logs/cloud_storage_sink")
+    logs = gcp_log_toolbox.timeWindowLogs(logs, "2019-06-17 00:00:00", "2019-06-17 23:59:59")
+    logs = gcp_log_toolbox.filterLogs(logs, "severity=ERROR,severity=NOTICE", "exclude")
+    count, x = gcp_log_toolbox.aggregateLogs(logs, ["severity", "resource.type"])
+    assert count > 0
+    assert set(x["severity"]) == {"INFO"}
+    assert sum(x["resource.type"].values()) == count
+
+
+def test_mergeWindows():
+    windows = [(datetime(2019, 6, 17, 9, 0), datetime(2019, 6, 17, 9, 30)),
+               (datetime(2019, 6, 16, 8, 0), datetime(2019, 6, 16, 9, 0)),
+               (datetime(2019, 6, 17, 9, 15), datetime(2019, 6, 17, 10, 0))]
+    merged = gcp_log_toolbox.mergeWindows(windows)
+    starts = [start for start, end in merged]
+    assert merged == [(datetime(2019, 6, 16, 8, 0), datetime(2019, 6, 16, 9, 0)),
+                      (datetime(2019, 6, 17, 9, 0), datetime(2019, 6, 17, 10, 0))]
+    assert gcp_log_toolbox.findWindow(merged, starts, datetime(2019, 6, 17, 9, 45)) == 1
+    assert gcp_log_toolbox.findWindow(merged, starts, datetime(2019, 6, 16, 12, 0)) is None
+
+
+def test_timesliceBatch_split():
+    with open("./unit_test_logs/pivots_split_tmp.txt", "w") as f:
+        f.write("2019-06-17 09:30:00\n2019-06-17 09:45:00\n")
+    gcp_log_toolbox.timesliceBatch("./unit_test_logs/cloud_storage_sink",
+                                   True,
+                                   "./unit_test_logs/timesliceBatch_split_tmp",
+                                   60,
+                                   "./unit_test_logs/pivots_split_tmp.txt",
+                                   split=True)
+    fileList = sorted(os.listdir("./unit_test_logs/timesliceBatch_split_tmp"))
+    for name in fileList:
+        os.remove(os.path.join("./unit_test_logs/timesliceBatch_split_tmp", name))
+    os.rmdir("./unit_test_logs/timesliceBatch_split_tmp")
+    os.remove("./unit_test_logs/pivots_split_tmp.txt")
+    assert len(fileList) == 2
+    assert fileList[0].startswith("2019-06-17_09_00_00_2019-06-17_10_00_00")
+    assert fileList[1].startswith("2019-06-17_09_15_00_2019-06-17_10_15_00")
+
+
+def test_timesliceBatch():
+    with open("./unit_test_logs/pivots_tmp.txt", "w") as f:
+        f.write("# alert times\n2019-06-17 09:30:00\n2019-06-17 09:45:00\n\n2019-06-16 08:00:00 > 2019-06-16 09:00:00\n")
+    gcp_log_toolbox.timesliceBatch("./unit_test_logs/cloud_storage_sink",
+                                   True,
+                                   "./unit_test_logs/timesliceBatch_tmp.json",
+                                   60,
+                                   "./unit_test_logs/pivots_tmp.txt")
+    with open("./unit_test_logs/timesliceBatch_tmp.json") as f:
+        content = [json.loads(line) for line in f]
+
+    os.remove("./unit_test_logs/pivots_tmp.txt")
+    os.remove("./unit_test_logs/timesliceBatch_tmp.json")
+    windows = set(window for log in content for window in log['timesliceWindows'])
+    assert len(content) > 0
+    assert windows == {"2019-06-16 08:00:00 > 2019-06-16 09:00:00",
+                       "2019-06-17 09:00:00 > 2019-06-17 10:00:00",
+                       "2019-06-17 09:15:00 > 2019-06-17 10:15:00"}
+    for log in content:
+        if "2019-06-17T09:15:00" <= log['timestamp'] < "2019-06-17T10:00:00":
+            assert len(log['timesliceWindows']) == 2
+
+
+def test_parsePivots_reversed():
+    with open("./unit_test_logs/pivots_reversed_tmp.txt", "w") as f:
+        f.write("2019-06-16 09:00:00 > 2019-06-16 08:00:00\n")
+    try:
+        gcp_log_toolbox.parsePivots("./unit_test_logs/pivots_reversed_tmp.txt", 60)
+        raised = False
+    except Exception:
+        raised = True
+    os.remove("./unit_test_logs/pivots_reversed_tmp.txt")
+    assert raised
+
+
+def test_flattenLog():
+    log = {"insertId": "a1", "resource": {"labels": {"project_id": "p1"}, "type": "gce_instance"}, "tags": ["x", "y"]}
+    flat = gcp_log_toolbox.flattenLog(log)
+    assert flat == {"insertId": "a1", "resource.labels.project_id": "p1", "resource.type": "gce_instance", "tags": '["x", "y"]'}
+
+
+def test_exportLogs_csv():
+    count = gcp_log_toolbox.exportLogs("./unit_test_logs/json_lines_small.json",
+                                       "./unit_test_logs/export_tmp.csv",
+                                       "csv",
+                                       ["timestamp", "resource.type", "protoPayload.authenticationInfo.principalEmail"])
+    with open("./unit_test_logs/export_tmp.csv", newline='') as f:
+        content = list(csv.reader(f))
+
+    os.remove("./unit_test_logs/export_tmp.csv")
+    assert count == 555
+    assert len(content) == 556
+    assert content[0] == ["timestamp", "resource.type", "protoPayload.authenticationInfo.principalEmail"]
+    assert content[1][1] == "gcs_bucket"
+
+
+def test_TabularWriter_inferred_columns(caplog):
+    writer = gcp_log_toolbox.TabularWriter("./unit_test_logs/tabular_tmp.csv", "csv", rowGroupSize=1)
+    writer.write({"insertId": "1", "textPayload": "café ✓"})
+    writer.write({"insertId": "2", "labels": {"a": "x", "b": "y"}})
+    writer.close()
+    with open("./unit_test_logs/tabular_tmp.csv", newline='', encoding='utf-8') as f:
+        content = list(csv.reader(f))
+
+    os.remove("./unit_test_logs/tabular_tmp.csv")
+    assert content == [["insertId", "textPayload"], ["1", "café ✓"], ["2", ""]]
+    assert "2 fields first seen after the columns were inferred" in caplog.text
+
+
+def test_mergeLogs():
+    os.makedirs("./unit_test_logs/merge_tmp")
+    with open("./unit_test_logs/json_lines_small.json") as f:
+        content = f.readlines()
+    with open("./unit_test_logs/merge_tmp/a.json", "w") as o:
+        o.writelines(content[:10])
+        o.write(content[10].rstrip("\n"))
+    with open("./unit_test_logs/merge_tmp/b.json", "w") as o:
+        o.writelines(content[11:20])
+
+    gcp_log_toolbox.mergeLogs("./unit_test_logs/merge_tmp/*.json", True, "./unit_test_logs/merge_tmp.json", False)
+    with open("./unit_test_logs/merge_tmp.json") as f:
+        merged = f.readlines()
+
+    os.remove("./unit_test_logs/merge_tmp/a.json")
+    os.remove("./unit_test_logs/merge_tmp/b.json")
+    os.rmdir("./unit_test_logs/merge_tmp")
+    os.remove("./unit_test_logs/merge_tmp.json")
+    assert sorted(merged) == sorted(content[:20])
+
+
+def test_copyFileData():
+    with open("./unit_test_logs/json_lines_small.json", "rb") as i, open("./unit_test_logs/copy_tmp.json", "wb") as o:
+        copied = gcp_log_toolbox.copyFileData(i.fileno(), o.fileno(), os.path.getsize("./unit_test_logs/json_lines_small.json"))
+    with open("./unit_test_logs/json_lines_small.json", "rb") as a, open("./unit_test_logs/copy_tmp.json", "rb") as b:
+        assert a.read() == b.read()
+    os.remove("./unit_test_logs/copy_tmp.json")
+    assert copied == os.path.getsize("./unit_test_logs/json_lines_small.json")
+
+
+def test_buildIndex_lookup():
+    with open("./unit_test_logs/json_lines_small.json") as f:
+        content = f.readlines()
+    with open("./unit_test_logs/index_tmp.json", "w") as o:
+        o.writelines(content[:100])
+
+    fields = ["insertId", "protoPayload.authenticationInfo.principalEmail"]
+    count = gcp_log_toolbox.buildIndex("./unit_test_logs/index_tmp.json", False, "./unit_test_logs/index_tmp.db", fields)
+    assert count > 100
+    with open("./unit_test_logs/index_tmp.json", "a") as o:
+        o.writelines(content[100:])
+    gcp_log_toolbox.buildIndex("./unit_test_logs/index_tmp.json", False, "./unit_test_logs/index_tmp.db", fields)
+
+    insertId = json.loads(content[300])['insertId']
+    logs = list(gcp_log_toolbox.iterLookupLogs("./unit_test_logs/index_tmp.db", "insertId", insertId))
+    assert logs == [json.loads(content[300])]
+
+    gcp_log_toolbox.lookupLogs("./unit_test_logs/index_tmp.db",
+                               "protoPayload.authenticationInfo.principalEmail=test@testdomain.com",
+                               "./unit_test_logs/lookup_tmp.json")
+    with open("./unit_test_logs/lookup_tmp.json") as f:
+        found = f.readlines()
+    expected = [line for line in content
+                if json.loads(line).get('protoPayload', {}).get('authenticationInfo', {}).get('principalEmail') == "test@testdomain.com"]
+
+    os.remove("./unit_test_logs/index_tmp.json")
+    os.remove("./unit_test_logs/index_tmp.db")
+    os.remove("./unit_test_logs/lookup_tmp.json")
+    assert len(found) == len(expected) > 0
+
+
+def test_sortKey():
+    assert gcp_log_toolbox.sortKey("2019-07-23T13:23:06Z") < gcp_log_toolbox.sortKey("2019-07-23T13:23:06.5Z")
+    assert gcp_log_toolbox.sortKey("2019-07-23T13:23:06.608Z") < gcp_log_toolbox.sortKey("2019-07-23T13:23:06.706597353Z")
+    assert gcp_log_toolbox.sortKey(None) < gcp_log_toolbox.sortKey("2019-07-23T13:23:06Z")
+
+
+def test_sortLogs():
+    with open("./unit_test_logs/json_lines_small.json", "rb") as f:
+        content = f.readlines()
+    with open("./unit_test_logs/sort_tmp.json", "wb") as o:
+        o.writelines(reversed(content))
+
+    count = gcp_log_toolbox.sortLogs("./unit_test_logs/sort_tmp.json", "./unit_test_logs/sorted_tmp.json", memory=0, tempdir="./unit_test_logs")
+    with open("./unit_test_logs/sorted_tmp.json", "rb") as f:
+        result = f.readlines()
+
+    os.remove("./unit_test_logs/sort_tmp.json")
+    os.remove("./unit_test_logs/sorted_tmp.json")
+    keys = [gcp_log_toolbox.sortKey(json.loads(line)['timestamp']) for line in result]
+    assert count == 555
+    assert keys == sorted(keys)
+    assert sorted(result) == sorted(content)
+    assert not [name for name in os.listdir("./unit_test_logs") if name.endswith(".run")]
+
+
+def test_followLogs_unterminated_last_line():
+    gcp_log_toolbox.gcloudFormatter("./unit_test_logs/gcloud_array_small.json", "./unit_test_logs/follow_gcloud_tmp.json")
+    batches = list(gcp_log_toolbox.followLogs("./unit_test_logs/follow_gcloud_tmp.json", None, 0, 1))
+    os.remove("./unit_test_logs/follow_gcloud_tmp.json")
+    assert sum(len(b) for b in batches) == 555
+
+
+def test_followStatistics_checkpoint(capsys):
+    with open("./unit_test_logs/json_lines_small.json") as f:
+        content = f.readlines()
+    with open("./unit_test_logs/follow_stats_tmp.json", "w") as o:
+        o.writelines(content[:100])
+    gcp_log_toolbox.followStatistics("./unit_test_logs/follow_stats_tmp.json", "./unit_test_logs/follow_stats_tmp.checkpoint", 0, 1)
+    with open("./unit_test_logs/follow_stats_tmp.json", "a") as o:
+        o.writelines(content[100:])
+    capsys.readouterr()
+    gcp_log_toolbox.followStatistics("./unit_test_logs/follow_stats_tmp.json", "./unit_test_logs/follow_stats_tmp.checkpoint", 0, 1)
+    printed = capsys.readouterr().out
+
+    os.remove("./unit_test_logs/follow_stats_tmp.json")
+    os.remove("./unit_test_logs/follow_stats_tmp.checkpoint")
+    assert "Total log count\n---------------------\n555\n" in printed
+    assert "Oldest Log: 2019-07-22 20:04:31.212077+00:00" in printed
+
+
+def test_PartitionWriter_sanitised_keys():
+    writer = gcp_log_toolbox.PartitionWriter("./unit_test_logs/partition_keys_tmp", "logName")
+    pathA = writer.getPath("projects/a/logs/x")
+    pathB = writer.getPath("projects:a/logs/x")
+    os.rmdir("./unit_test_logs/partition_keys_tmp")
+    assert pathA != pathB
+    assert writer.getPath("gce_instance").endswith("gce_instance.json")
+
+
+def test_timeframe_partition_flushed_on_error():
+    with open("./unit_test_logs/json_lines_small.json") as f:
+        content = f.readlines()
+    with open("./unit_test_logs/partition_error_tmp.json", "w") as o:
+        o.writelines(content[:50])
+        o.write("{not json\n")
+    try:
+        gcp_log_toolbox.timeframe("./unit_test_logs/partition_error_tmp.json",
+                                  True,
+                                  "./unit_test_logs/partition_error_tmp",
+                                  "2019-07-01 00:00:00 > 2019-08-01 00:00:00",
+                                  partition="resource.type")
+        raised = False
+    except ValueError:
+        raised = True
+
+    count = 0
+    for name in os.listdir("./unit_test_logs/partition_error_tmp"):
+        with open(os.path.join("./unit_test_logs/partition_error_tmp", name)) as f:
+            count += len(f.readlines())
+        os.remove(os.path.join("./unit_test_logs/partition_error_tmp", name))
+    os.rmdir("./unit_test_logs/partition_error_tmp")
+    os.remove("./unit_test_logs/partition_error_tmp.json")
+    assert raised
+    assert count == 50
+
+
+def test_copyFileData_short_copy(monkeypatch):
+    # A kernel copy that stops early must fall back rather than truncate
+    monkeypatch.setattr(os, "copy_file_range", lambda inFd, outFd, count: 0, raising=False)
+    monkeypatch.setattr(os, "sendfile", lambda outFd, inFd, offset, count: 0, raising=False)
+    size = os.path.getsize("./unit_test_logs/json_lines_small.json")
+    with open("./unit_test_logs/json_lines_small.json", "rb") as i, open("./unit_test_logs/copy_short_tmp.json", "wb") as o:
+        copied = gcp_log_toolbox.copyFileData(i.fileno(), o.fileno(), size)
+    with open("./unit_test_logs/json_lines_small.json", "rb") as a, open("./unit_test_logs/copy_short_tmp.json", "rb") as b:
+        same = a.read() == b.read()
+    os.remove("./unit_test_logs/copy_short_tmp.json")
+    assert copied == size
+    assert same
+
+
+def test_mergeLogs_short_copy(monkeypatch):
+    monkeypatch.setattr(gcp_log_toolbox, "copyFileData", lambda inFd, outFd, size: size - 1)
+    try:
+        gcp_log_toolbox.mergeLogs("./unit_test_logs/cloud_storage_sink/cloudaudit.googleapis.com/activity/2019/06/16/*.json",
+                                  True, "./unit_test_logs/merge_short_tmp.json", False)
+        raised = False
+    except Exception:
+        raised = True
+    os.remove("./unit_test_logs/merge_short_tmp.json")
+    assert raised
+
+
+def test_buildIndex_gcloudformatter_output():
+    gcp_log_toolbox.gcloudFormatter("./unit_test_logs/gcloud_array_small.json", "./unit_test_logs/index_gcloud_tmp.json")
+    gcp_log_toolbox.buildIndex("./unit_test_logs/index_gcloud_tmp.json", False, "./unit_test_logs/index_gcloud_tmp.db", ["insertId"])
+    lastId = gcp_log_toolbox.readLog("./unit_test_logs/gcloud_array_small.json")[-1]['insertId']
+    logs = list(gcp_log_toolbox.iterLookupLogs("./unit_test_logs/index_gcloud_tmp.db", "insertId", lastId))
+    os.remove("./unit_test_logs/index_gcloud_tmp.json")
+    os.remove("./unit_test_logs/index_gcloud_tmp.db")
+    assert len(logs) == 1
+
+
+def test_buildIndex_regenerated_file():
+    with open("./unit_test_logs/json_lines_small.json") as f:
+        content = f.readlines()
+    with open("./unit_test_logs/index_regen_tmp.json", "w") as o:
+        o.writelines(content[:100])
+    gcp_log_toolbox.buildIndex("./unit_test_logs/index_regen_tmp.json", False, "./unit_test_logs/index_regen_tmp.db", ["insertId"])
+
+    # Regenerate the file in place with different logs of a larger size
+    with open("./unit_test_logs/index_regen_tmp.json", "w") as o:
+        o.writelines(content[200:400])
+    staleId = json.loads(content[50])['insertId']
+    assert list(gcp_log_toolbox.iterLookupLogs("./unit_test_logs/index_regen_tmp.db", "insertId", staleId)) == []
+
+    gcp_log_toolbox.buildIndex("./unit_test_logs/index_regen_tmp.json", False, "./unit_test_logs/index_regen_tmp.db", ["insertId"])
+    newId = json.loads(content[300])['insertId']
+    staleLogs = list(gcp_log_toolbox.iterLookupLogs("./unit_test_logs/index_regen_tmp.db", "insertId", staleId))
+    newLogs = list(gcp_log_toolbox.iterLookupLogs("./unit_test_logs/index_regen_tmp.db", "insertId", newId))
+    os.remove("./unit_test_logs/index_regen_tmp.json")
+    os.remove("./unit_test_logs/index_regen_tmp.db")
+    assert staleLogs == []
+    assert newLogs == [json.loads(content[300])]
+
+
+def test_buildIndex_moved_file():
+    with open("./unit_test_logs/json_lines_small.json") as f:
+        content = f.readlines()
+    with open("./unit_test_logs/index_moved_tmp.json", "w") as o:
+        o.writelines(content[:100])
+    gcp_log_toolbox.buildIndex("./unit_test_logs/index_moved_tmp.json", False, "./unit_test_logs/index_moved_tmp.db", ["insertId"])
+    os.rename("./unit_test_logs/index_moved_tmp.json", "./unit_test_logs/index_moved_tmp2.json")
+    logs = list(gcp_log_toolbox.iterLookupLogs("./unit_test_logs/index_moved_tmp.db", "insertId", json.loads(content[50])['insertId']))
+    os.remove("./unit_test_logs/index_moved_tmp2.json")
+    os.remove("./unit_test_logs/index_moved_tmp.db")
+    assert logs == []
+
+
+def test_sortLogs_numeric_field():
+    codes = [404, 50, 200, 5, None, 1000, 500]
+    with open("./unit_test_logs/sort_numeric_tmp.json", "w") as o:
+        for i, code in enumerate(codes):
+            log = {"insertId": str(i), "httpRequest": {}}
+            if code is not None:
+                log["httpRequest"]["status"] = code
+            o.write(json.dumps(log) + "\n")
+
+    gcp_log_toolbox.sortLogs("./unit_test_logs/sort_numeric_tmp.json", "./unit_test_logs/sorted_numeric_tmp.json",
+                             field="httpRequest.status", memory=0, tempdir="./unit_test_logs")
+    with open("./unit_test_logs/sorted_numeric_tmp.json") as f:
+        result = [json.loads(line)["httpRequest"].get("status") for line in f]
+
+    os.remove("./unit_test_logs/sort_numeric_tmp.json")
+    os.remove("./unit_test_logs/sorted_numeric_tmp.json")
+    assert result == [None, 5, 50, 200, 404, 500, 1000]
+    assert gcp_log_toolbox.sortKey(9) < gcp_log_toolbox.sortKey(10) < gcp_log_toolbox.sortKey("2019-07-23T13:23:06Z") < gcp_log_toolbox.sortKey("abc")